@@ -16,7 +16,7 @@ import binascii
 class MData(object):
 
     def __init__(self, data=b"", characterSet='utf-8'):
-        # data肯定为bytes
+        # data为bytes或bytearray(加解密结果)
         self.data = data
         self.characterSet = characterSet
 
@@ -74,53 +74,35 @@ class AEScryptor(object):
         self.paddingMode = paddingMode
         self.data = ""
 
-    def __ZeroPadding(self, data):
-        data += b'\x00'
-        while len(data) % 16 != 0:
-            data += b'\x00'
-        return data
-
-    def __StripZeroPadding(self, data):
-        data = data[:-1]
-        while len(data) % 16 != 0:
-            data = data.rstrip(b'\x00')
-            if data[-1] != b"\x00":
-                break
-        return data
-
-    def __PKCS5_7Padding(self, data):
-        needSize = 16 - len(data) % 16
-        if needSize == 0:
-            needSize = 16
-        return data + needSize.to_bytes(1, 'little') * needSize
-
-    def __StripPKCS5_7Padding(self, data):
-        paddingSize = data[-1]
-        return data.rstrip(paddingSize.to_bytes(1, 'little'))
-
-    def __paddingData(self, data):
+    def __paddingBytes(self, length):
+        """长度为length的数据需要追加的填充字节，一次计算完成，不支持的填充模式返回None"""
         if self.paddingMode == "NoPadding":
-            if len(data) % 16 == 0:
-                return data
-            else:
-                return self.__ZeroPadding(data)
+            # 长度已对齐时不填充，否则按ZeroPadding补齐
+            return b'\x00' * (-length % 16)
         elif self.paddingMode == "ZeroPadding":
-            return self.__ZeroPadding(data)
+            # 至少填充一个0字节，与旧版保持一致
+            return b'\x00' * (16 - length % 16)
         elif self.paddingMode == "PKCS5Padding" or self.paddingMode == "PKCS7Padding":
-            return self.__PKCS5_7Padding(data)
+            needSize = 16 - length % 16
+            return bytes((needSize,)) * needSize
         else:
             print("不支持Padding")
 
-    def __stripPaddingData(self, data):
-        if self.paddingMode == "NoPadding":
-            return self.__StripZeroPadding(data)
-        elif self.paddingMode == "ZeroPadding":
-            return self.__StripZeroPadding(data)
-
+    def __unpaddedLength(self, data):
+        """data: 解密后的bytearray，返回去掉填充后的长度"""
+        if self.paddingMode == "NoPadding" or self.paddingMode == "ZeroPadding":
+            end = len(data)
+            while end and data[end - 1] == 0:
+                end -= 1
+            return end
         elif self.paddingMode == "PKCS5Padding" or self.paddingMode == "PKCS7Padding":
-            return self.__StripPKCS5_7Padding(data)
+            paddingSize = data[-1] if data else 0
+            if not 1 <= paddingSize <= 16 or paddingSize > len(data):
+                raise ValueError('PKCS7填充错误')
+            return len(data) - paddingSize
         else:
             print("不支持Padding")
+            return len(data)
 
     def setCharacterSet(self, characterSet):
         """
@@ -179,30 +161,135 @@ class AEScryptor(object):
         self.data = data.encode(self.characterSet)
         return self.__encrypt()
 
-    def __encrypt(self):
+    def encryptFromBytes(self, data):
+        """
+        对二进制数据进行AES加密
+        data: 数据类型bytes
+        """
+        self.data = data
+        return self.__encrypt()
+
+    def __newCipher(self):
         if self.mode == AES.MODE_CBC:
-            aes = AES.new(self.key, self.mode, self.iv)
+            return AES.new(self.key, self.mode, self.iv)
         elif self.mode == AES.MODE_ECB:
-            aes = AES.new(self.key, self.mode)
+            return AES.new(self.key, self.mode)
         else:
             print("不支持这种模式")
-            return
 
-        data = self.__paddingData(self.data)
-        enData = aes.encrypt(data)
-        return MData(enData)
+    def __encrypt(self):
+        cipher = self.__newCipher()
+        padding = self.__paddingBytes(len(self.data))
+        if cipher is None or padding is None:
+            return
+        # 对齐部分直接从原数据加密到输出缓冲区，只有最后不足一块的数据和填充拼接(不超过31字节)
+        data = memoryview(self.data)
+        full = len(data) - len(data) % 16
+        tail = bytes(data[full:]) + padding
+        enData = bytearray(full + len(tail))
+        output = memoryview(enData)
+        if full:
+            cipher.encrypt(data[:full], output=output[:full])
+        if tail:
+            cipher.encrypt(tail, output=output[full:])
+        return MData(enData, characterSet=self.characterSet)
 
     def __decrypt(self):
-        if self.mode == AES.MODE_CBC:
-            aes = AES.new(self.key, self.mode, self.iv)
-        elif self.mode == AES.MODE_ECB:
-            aes = AES.new(self.key, self.mode)
-        else:
-            print("不支持这种模式")
+        cipher = self.__newCipher()
+        if cipher is None:
+            return
+        data = bytearray(len(self.data))
+        cipher.decrypt(self.data, output=data)
+        # 原地截断填充
+        del data[self.__unpaddedLength(data):]
+        return MData(data, characterSet=self.characterSet)
+
+    @staticmethod
+    def __readinto(reader, view):
+        readinto = getattr(reader, 'readinto', None)
+        if readinto is not None:
+            return readinto(view) or 0
+        chunk = reader.read(len(view))
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+    def encryptStream(self, reader, writer, chunkSize=65536):
+        """
+        流式加密，结果与一次性加密相同，内存占用固定为两个chunkSize大小的缓冲区
+        reader: 可读的二进制文件对象(支持readinto时不产生额外拷贝)
+        writer: 可写的二进制文件对象
+        chunkSize: 每次读取的字节数，按16字节对齐
+        返回写入的字节数
+        """
+        cipher = self.__newCipher()
+        if cipher is None:
             return
-        data = aes.decrypt(self.data)
-        mData = MData(self.__stripPaddingData(data), characterSet=self.characterSet)
-        return mData
+        chunkSize = max(16, chunkSize - chunkSize % 16)
+        buffer = bytearray(chunkSize + 16)
+        view = memoryview(buffer)
+        output = memoryview(bytearray(chunkSize + 16))
+        # buffer开头尚未加密的字节数(不足一块)
+        pending = 0
+        length = 0
+        while True:
+            size = self.__readinto(reader, view[pending:pending + chunkSize])
+            if not size:
+                break
+            pending += size
+            length += size
+            full = pending - pending % 16
+            if full:
+                cipher.encrypt(view[:full], output=output[:full])
+                writer.write(output[:full])
+                buffer[:pending - full] = view[full:pending]
+                pending -= full
+        padding = self.__paddingBytes(length)
+        if padding is None:
+            return
+        tail = bytes(view[:pending]) + padding
+        if tail:
+            writer.write(cipher.encrypt(tail))
+        return length - pending + len(tail)
+
+    def decryptStream(self, reader, writer, chunkSize=65536):
+        """
+        流式解密，最后一块读到结尾后才去掉填充
+        ZeroPadding只去掉最后一块末尾的0字节，需要完整还原以0结尾的数据时请使用PKCS7Padding
+        reader: 可读的二进制文件对象
+        writer: 可写的二进制文件对象
+        chunkSize: 每次读取的字节数，按16字节对齐
+        返回写入的字节数，密文长度不是16的倍数时抛出ValueError
+        """
+        cipher = self.__newCipher()
+        if cipher is None:
+            return
+        chunkSize = max(16, chunkSize - chunkSize % 16)
+        buffer = bytearray(chunkSize + 32)
+        view = memoryview(buffer)
+        output = memoryview(bytearray(chunkSize + 32))
+        pending = 0
+        length = 0
+        while True:
+            size = self.__readinto(reader, view[pending:pending + chunkSize])
+            if not size:
+                break
+            pending += size
+            # 保留最后一块，到结尾时再处理填充
+            full = pending - pending % 16 - 16
+            if full > 0:
+                cipher.decrypt(view[:full], output=output[:full])
+                writer.write(output[:full])
+                length += full
+                buffer[:pending - full] = view[full:pending]
+                pending -= full
+        if pending % 16:
+            raise ValueError('密文长度错误')
+        if pending:
+            data = bytearray(cipher.decrypt(view[:pending]))
+            del data[self.__unpaddedLength(data):]
+            writer.write(data)
+            length += len(data)
+        return length
 
 
 if __name__ == '__main__':
@@ -0,0 +1,106 @@
+# -*- coding: UTF-8 -*-
+
+import hashlib
+import math
+import threading
+
+
+# 布隆过滤器
+class BloomFilter(object):
+
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        判断key一定不存在(没有误判)或可能存在(误判率约为error_rate)，不支持删除
+        capacity: 预计保存的key数量，超过后误判率上升，需要按更大的容量重建
+        error_rate: 保存capacity个key时的误判率
+        """
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        # 添加时至少设置了一个新位的key数量(近似的key数量)
+        self.count = 0
+
+    def _positions(self, key):
+        # 双重哈希：一次blake2b得到两个64位哈希值，组合出hashes个位置
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    def add(self, key):
+        """返回key是否为新添加的(设置了至少一个新位)"""
+        added = False
+        bits = self.bits
+        for position in self._positions(key):
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                bits[position >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def __len__(self):
+        return self.count
+
+
+# 可重建的key过滤器
+class KeyFilter(object):
+
+    def __init__(self, error_rate=0.001, min_capacity=100000, rebuild_ratio=0.1):
+        """
+        布隆过滤器不能删除key，删除的key仍判断为可能存在(只影响误判率，不会误判为不存在)
+        删除数超过key数量的rebuild_ratio，或key数量超过容量时needs_rebuild()返回True，由调用方定期重建
+        重建期间新增的key先记录下来，重建完成后补充到新过滤器中再替换
+        """
+        self.error_rate = error_rate
+        self.min_capacity = min_capacity
+        self.rebuild_ratio = rebuild_ratio
+        self.deletes = 0
+        self._filter = BloomFilter(min_capacity, error_rate)
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def build(self, iter_keys, count):
+        """
+        iter_keys: 返回全部key的迭代器的函数，开始记录新增的key之后才调用，保证不遗漏
+        count: key数量，按两倍容量创建过滤器
+        """
+        with self._lock:
+            self._pending = []
+            self.deletes = 0
+        bloom = BloomFilter(max(self.min_capacity, count * 2), self.error_rate)
+        for key in iter_keys():
+            bloom.add(key)
+        with self._lock:
+            for key in self._pending:
+                bloom.add(key)
+            self._filter = bloom
+            self._pending = None
+
+    def add(self, key):
+        with self._lock:
+            self._filter.add(key)
+            if self._pending is not None:
+                self._pending.append(key)
+
+    def discard(self, key):
+        """记录一次删除"""
+        with self._lock:
+            self.deletes += 1
+
+    def __contains__(self, key):
+        return key in self._filter
+
+    def needs_rebuild(self):
+        bloom = self._filter
+        return self.deletes > bloom.count * self.rebuild_ratio or bloom.count > bloom.capacity
+
+    def __len__(self):
+        return len(self._filter)
@@ -0,0 +1,265 @@
+# -*- coding: UTF-8 -*-
+
+import csv
+import io
+import itertools
+import json
+import sys
+from collections import deque
+
+from clock_model import TIME_FORMAT, clock, parse_time
+
+
+def _check_time(value, field):
+    try:
+        if not isinstance(value, str) or not value:
+            raise ValueError
+        parse_time(value)
+    except ValueError:
+        raise ValueError(f'{field}格式应为{TIME_FORMAT}')
+    return value
+
+
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y')
+
+
+def validate_user(row):
+    """校验一行用户数据，返回可直接写入数据库的用户记录，不合法时抛出ValueError"""
+    machine_code = str(row.get('machine_code') or '').strip()
+    if not machine_code or len(machine_code) > 32:
+        raise ValueError('非法的机器码')
+    reg_date = row.get('reg_date') or clock.now_str()
+    return {
+        'machine_code': machine_code,
+        'expire_date': _check_time(row.get('expire_date'), 'expire_date'),
+        'reg_date': _check_time(reg_date, 'reg_date'),
+        'app_category': str(row.get('app_category') or ''),
+        'remark': str(row.get('remark') or ''),
+        'aes_config_id': str(row.get('aes_config_id') or 'default'),
+    }
+
+
+def validate_card(row):
+    """校验一行充值卡数据，返回可直接写入数据库的充值卡记录，不合法时抛出ValueError"""
+    card_number = str(row.get('card_number') or '').strip()
+    card_pass = str(row.get('card_pass') or '').strip()
+    if not card_number or not card_pass:
+        raise ValueError('卡号和卡密不能为空')
+    try:
+        days = int(row.get('days'))
+    except (TypeError, ValueError):
+        raise ValueError('days应为整数')
+    if days <= 0:
+        raise ValueError('days应大于0')
+    return {
+        'card_number': card_number,
+        'card_pass': card_pass,
+        'days': days,
+        'used': _to_bool(row.get('used', False)),
+        'used_machine_code': str(row.get('used_machine_code') or ''),
+        # 导出文件中未使用的卡used_time为空，数据库原始记录中为0，都表示未设置
+        'used_time': '' if str(row.get('used_time') or '').strip() in ('', '0') else _check_time(row['used_time'], 'used_time'),
+    }
+
+
+# 流式批量导入
+# csv.reader的输入，从队列中逐行取出，队列为空时结束本次读取
+class _LineSource(object):
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.lines:
+            raise StopIteration
+        return self.lines.popleft()
+
+
+class BulkImporter(object):
+
+    VALIDATORS = {'users': (validate_user, 'machine_code'), 'cards': (validate_card, 'card_number')}
+
+    def __init__(self, kind, fmt='csv', batch_size=5000, max_errors=100):
+        """
+        逐行读入CSV(首行为表头)或JSONL数据，校验并去重后攒成批次，由调用方整批提交
+        内存占用只与batch_size有关，与文件大小无关
+        kind: users 或 cards
+        fmt: csv 或 jsonl
+        batch_size: 每批提交的记录数
+        max_errors: 进度中最多保留的错误明细条数
+        """
+        if kind not in self.VALIDATORS:
+            raise ValueError('kind只能为users或cards')
+        if fmt not in ('csv', 'jsonl'):
+            raise ValueError('fmt只能为csv或jsonl')
+        self.kind = kind
+        self.fmt = fmt
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+        self.validate, self.key = self.VALIDATORS[kind]
+        self.header = None
+        self.lineno = 0
+        # 当前记录的起始行号，CSV中引号内的字段可以跨行
+        self.record_lineno = 0
+        self.batch = []
+        self._batch_keys = set()
+        # 整个导入过程共用一个csv.reader，从_lines中逐行读取，只在攒齐一条完整记录后才读取
+        self._lines = deque()
+        self._reader = csv.reader(_LineSource(self._lines))
+        self._quoted = False
+        self.progress = {'rows': 0, 'imported': 0, 'duplicates': 0, 'invalid': 0, 'errors': []}
+
+    def _parse(self, line):
+        if self.fmt == 'jsonl':
+            if not line.strip():
+                return None
+            row = json.loads(line)
+            if not isinstance(row, dict):
+                raise ValueError('每行应为JSON对象')
+            return row
+        self._lines.append(line + '\n')
+        # 引号数为奇数时引号未闭合，换行属于字段内容，继续读入下一行
+        if line.count('"') % 2:
+            self._quoted = not self._quoted
+        if self._quoted:
+            return None
+        values = next(self._reader, [])
+        self._lines.clear()
+        if not any(value.strip() for value in values):
+            return None
+        if self.header is None:
+            self.header = [name.strip() for name in values]
+            return None
+        return dict(zip(self.header, values))
+
+    def _error(self, error):
+        self.progress['invalid'] += 1
+        if len(self.progress['errors']) < self.max_errors:
+            self.progress['errors'].append({'line': self.record_lineno, 'error': error})
+
+    def feed(self, line):
+        """读入一行，攒满一批时返回该批次，否则返回None"""
+        self.lineno += 1
+        if not self._quoted:
+            self.record_lineno = self.lineno
+        line = line.rstrip('\r\n')
+        if self.lineno == 1:
+            line = line.lstrip('\ufeff')
+        try:
+            row = self._parse(line)
+            if row is None:
+                return None
+            self.progress['rows'] += 1
+            record = self.validate(row)
+        except (ValueError, csv.Error) as e:
+            self._error(str(e))
+            return None
+        # 批次内去重，与数据库中已有记录的去重由提交时的索引查询完成
+        if record[self.key] in self._batch_keys:
+            self.progress['duplicates'] += 1
+            return None
+        self._batch_keys.add(record[self.key])
+        self.batch.append(record)
+        if len(self.batch) >= self.batch_size:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """取出当前未提交的批次(可能为空)，数据读完后调用时，引号未闭合的记录计为无效"""
+        if self._quoted:
+            self._quoted = False
+            self._lines.clear()
+            self._error('引号未闭合')
+        batch, self.batch = self.batch, []
+        self._batch_keys = set()
+        return batch
+
+    def record(self, result):
+        """记录一批提交结果(verification.import_users/import_cards的返回值)，返回当前进度"""
+        self.progress['imported'] += result['imported']
+        self.progress['duplicates'] += result['duplicates']
+        return self.progress
+
+    def dumps(self):
+        """当前进度的NDJSON行"""
+        return json.dumps(self.progress, ensure_ascii=False) + '\n'
+
+
+# 流式导出
+class BulkExporter(object):
+
+    FIELDS = {
+        'users': ('machine_code', 'expire_date', 'reg_date', 'app_category', 'remark', 'aes_config_id'),
+        'cards': ('card_number', 'card_pass', 'days', 'used', 'used_machine_code', 'used_time'),
+    }
+    CONTENT_TYPES = {'csv': 'text/csv; charset=utf-8', 'jsonl': 'application/x-ndjson'}
+
+    def __init__(self, kind, fmt, rows, chunk_rows=1000):
+        """
+        把记录迭代器按块编码为CSV(首行为表头)或JSONL，每次read()只取出chunk_rows条
+        kind: users 或 cards
+        fmt: csv 或 jsonl
+        rows: 记录迭代器(verification.export_users/export_cards的返回值)
+        """
+        if kind not in self.FIELDS:
+            raise ValueError('kind只能为users或cards')
+        if fmt not in self.CONTENT_TYPES:
+            raise ValueError('fmt只能为csv或jsonl')
+        self.kind = kind
+        self.fmt = fmt
+        self.fields = self.FIELDS[kind]
+        self.content_type = self.CONTENT_TYPES[fmt]
+        self.rows = iter(rows)
+        self.chunk_rows = chunk_rows
+        self._header = fmt == 'csv'
+
+    def read(self):
+        """返回下一块数据，导出完毕时返回空字符串"""
+        buffer = io.StringIO()
+        if self._header:
+            self._header = False
+            csv.writer(buffer).writerow(self.fields)
+        rows = itertools.islice(self.rows, self.chunk_rows)
+        if self.fmt == 'csv':
+            csv.writer(buffer).writerows([row.get(name, '') for name in self.fields] for row in rows)
+        else:
+            for row in rows:
+                buffer.write(json.dumps({name: row.get(name, '') for name in self.fields}, ensure_ascii=False))
+                buffer.write('\n')
+        return buffer.getvalue()
+
+
+def import_file(verify, kind, path, fmt=None, batch_size=5000):
+    """把文件逐行导入数据库，每提交一批输出一次进度，返回最终进度"""
+    fmt = fmt or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+    importer = BulkImporter(kind, fmt, batch_size)
+    commit = verify.import_users if kind == 'users' else verify.import_cards
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        for line in f:
+            batch = importer.feed(line)
+            if batch:
+                print(importer.record(commit(batch)))
+    batch = importer.flush()
+    if batch:
+        importer.record(commit(batch))
+    return importer.progress
+
+
+if __name__ == '__main__':
+    # 请在服务停止时使用，服务运行中请使用后台接口 /admin/import/users 或 /admin/import/cards
+    # python3 bulk_model.py import users ./users.csv
+    if len(sys.argv) != 4 or sys.argv[1] != 'import' or sys.argv[2] not in ('users', 'cards'):
+        print('用法: python3 bulk_model.py import <users|cards> <CSV或JSONL文件路径>')
+        sys.exit(1)
+    from verification_model import verification
+    v = verification()
+    try:
+        print(import_file(v, sys.argv[2], sys.argv[3]))
+    finally:
+        v.close()
@@ -0,0 +1,146 @@
+# -*- coding: UTF-8 -*-
+
+import threading
+import time
+from collections import OrderedDict
+
+# get()未命中时的默认返回值，用于区分缓存了None和未缓存
+MISSING = object()
+
+
+# 带过期时间的LRU缓存
+class TTLCache(object):
+
+    def __init__(self, maxsize=100000, ttl=300):
+        """
+        线程安全的LRU缓存，超过maxsize时淘汰最久未使用的条目，条目写入ttl秒后过期
+        maxsize: 最大条目数
+        ttl: 过期时间/秒
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # 每次失效操作加1，用于丢弃失效之前读取的旧数据
+        self.version = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, version=None):
+        """
+        写入缓存，version为读取数据前取得的self.version
+        期间发生过失效操作时不写入，避免把失效前读到的旧数据放回缓存
+        """
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self.version += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# 防重放缓存
+class ReplayGuard(object):
+
+    # check()的返回值
+    ACCEPTED = 'accepted'
+    STALE = 'stale'
+    REPLAYED = 'replayed'
+
+    def __init__(self, window=300, maxsize=200000, bucket_seconds=10):
+        """
+        按请求时间戳分桶的环形签名缓存，只接受时间戳在当前时间前后window秒内的请求
+        桶过期时整桶丢弃，不需要逐条清理；所有桶合计最多保存maxsize个签名，超出时提前丢弃最旧的桶
+        提前丢弃的签名和当前桶已占满整个容量时未记录的签名计入evicted和overflow，请求本身不拒绝
+        多进程模式下每个worker各自记录
+        window: 时间窗口/秒
+        maxsize: 最多保存的签名数
+        bucket_seconds: 每个桶覆盖的秒数
+        """
+        self.window = window
+        self.maxsize = maxsize
+        self.bucket_seconds = bucket_seconds
+        # 窗口内的时间戳最多落在2*window/bucket_seconds+1个桶中，环的长度比它多一个
+        slots = 2 * window // bucket_seconds + 2
+        # [桶编号, 签名集合]
+        self._ring = [[None, set()] for _ in range(slots)]
+        self._size = 0
+        # 因超出容量提前丢弃的签名数，以及未能记录的签名数
+        self.evicted = 0
+        self.overflow = 0
+        self._lock = threading.Lock()
+
+    def check(self, timestamp, sign, now):
+        """
+        timestamp: 请求头中的时间戳(秒)
+        sign: 请求签名(客户端传入nonce时签名中包含nonce)，应在签名校验通过后再调用，避免伪造的签名占满缓存
+        now: 当前时间戳
+        返回ACCEPTED，或时间戳非法/超出窗口时返回STALE、签名已使用过返回REPLAYED
+        """
+        try:
+            timestamp = int(timestamp)
+        except ValueError:
+            return self.STALE
+        if abs(now - timestamp) > self.window:
+            return self.STALE
+        bucket = timestamp // self.bucket_seconds
+        with self._lock:
+            slot = self._ring[bucket % len(self._ring)]
+            if slot[0] != bucket:
+                if slot[0] is not None and slot[0] > bucket:
+                    # 槽位已被更新的桶占用，说明该时间戳早已超出窗口(时钟回拨)
+                    return self.STALE
+                self._size -= len(slot[1])
+                slot[0] = bucket
+                slot[1] = set()
+            signs = slot[1]
+            if sign in signs:
+                return self.REPLAYED
+            if self._size >= self.maxsize and not self._evict(bucket):
+                self.overflow += 1
+                return self.ACCEPTED
+            signs.add(sign)
+            self._size += 1
+            return self.ACCEPTED
+
+    def _evict(self, current):
+        """丢弃最旧的一个非当前桶，没有可丢弃的桶时返回False"""
+        oldest = None
+        for slot in self._ring:
+            if slot[1] and slot[0] != current and (oldest is None or slot[0] < oldest[0]):
+                oldest = slot
+        if oldest is None:
+            return False
+        self.evicted += len(oldest[1])
+        self._size -= len(oldest[1])
+        oldest[1] = set()
+        return True
+
+    def __len__(self):
+        return self._size
@@ -0,0 +1,59 @@
+# -*- coding: UTF-8 -*-
+
+import time
+from datetime import datetime, timedelta, timezone
+
+# 对外接口使用的时区和时间格式，数据库中统一保存整数时间戳(秒)
+TZ = timezone(timedelta(hours=8))
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# 查询参数中也可以只写日期，表示当天0点
+DATE_FORMAT = '%Y-%m-%d'
+
+
+def format_time(timestamp):
+    """整数时间戳 -> '%Y-%m-%d %H:%M:%S'，0或空值(未设置)返回空字符串"""
+    if not timestamp:
+        return ''
+    if isinstance(timestamp, str):
+        return timestamp
+    return datetime.fromtimestamp(timestamp, TZ).strftime(TIME_FORMAT)
+
+
+def parse_time(value):
+    """'%Y-%m-%d %H:%M:%S'或'%Y-%m-%d'(按TZ时区) -> 整数时间戳，整数原样返回，空字符串返回0，格式错误时抛出ValueError"""
+    if isinstance(value, int):
+        return value
+    if not value:
+        return 0
+    try:
+        parsed = datetime.strptime(value, TIME_FORMAT)
+    except ValueError:
+        parsed = datetime.strptime(value, DATE_FORMAT)
+    return int(parsed.replace(tzinfo=TZ).timestamp())
+
+
+# 按秒缓存格式化时间的时钟
+class CachedClock(object):
+
+    def __init__(self):
+        """
+        now()每次直接读取time.time()，本身开销很小，不做缓存
+        now_str()在同一秒内复用已格式化的时间字符串，热点路径只比较整数
+        """
+        self._second = None
+        self._text = ''
+
+    def now(self):
+        """当前整数时间戳(秒)"""
+        return int(time.time())
+
+    def now_str(self):
+        now = int(time.time())
+        if now != self._second:
+            # 多线程同时刷新时结果相同，无需加锁
+            self._text = format_time(now)
+            self._second = now
+        return self._text
+
+
+clock = CachedClock()
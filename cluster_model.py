@@ -0,0 +1,237 @@
+# -*- coding: UTF-8 -*-
+
+import asyncio
+import functools
+import multiprocessing
+import os
+import queue
+import threading
+from multiprocessing.connection import Client, Listener
+
+from sanic_session import InMemorySessionInterface
+from sanic_session.utils import ExpiringDict
+
+from verification_model import AsyncVerification, verification
+
+
+# 写进程
+class WriterServer(object):
+
+    def __init__(self, address, authkey):
+        """
+        多进程模式下唯一打开数据库进行写入的进程
+        worker通过rpc连接提交写操作，通过subscribe连接按顺序接收每次写入后变更的完整记录
+        address: Unix套接字路径
+        authkey: 连接认证密钥
+        """
+        self.verify = verification()
+        self.verify.listeners.append(self._capture)
+        self.listener = Listener(address, family='AF_UNIX', authkey=authkey)
+        # 后台管理登录状态，供所有worker共享
+        self.sessions = ExpiringDict()
+        self._lock = threading.Lock()
+        self._captured = []
+        self._subscribers = []
+        # 变更序号，每次产生变更的写入加1
+        self._seq = 0
+
+    def _capture(self, table, keys):
+        for key in keys:
+            self._captured.append((table, key))
+
+    def _snapshot(self, table, key):
+        """读取变更后的完整记录，记录已删除时返回None"""
+        if table == 'user':
+            doc = self.verify.db.find_user(key)
+        elif table == 'card':
+            doc = self.verify.db.find_card(key)
+        elif table == 'aes_configs':
+            doc = self.verify.db.find_aes_config(key)
+        elif table == 'lease_revocations':
+            return self.verify.get_lease_revocation(key)
+        else:
+            doc = {'name': key} if key in self.verify.db.list_app_categories() else None
+        return None if doc is None else dict(doc)
+
+    def serve_forever(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                continue
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        try:
+            if conn.recv() == 'subscribe':
+                self._subscribe(conn)
+                return
+            while True:
+                name, args, kwargs = conn.recv()
+                try:
+                    result, seq = self._call(name, args, kwargs)
+                    conn.send({'result': result, 'seq': seq, 'error': None})
+                except Exception as e:
+                    conn.send({'result': None, 'seq': self._seq, 'error': f'{name}: {e!r}'})
+        except (EOFError, OSError):
+            conn.close()
+
+    def _call(self, name, args, kwargs):
+        if name == 'session_get':
+            return self.sessions.get(*args), self._seq
+        if name == 'session_set':
+            self.sessions.set(*args)
+            return None, self._seq
+        if name == 'session_delete':
+            if args[0] in self.sessions:
+                self.sessions.delete(*args)
+            return None, self._seq
+        if name not in AsyncVerification.WRITE_METHODS:
+            raise ValueError('不支持的写操作')
+        with self._lock:
+            self._captured = []
+            try:
+                result = getattr(self.verify, name)(*args, **kwargs)
+            finally:
+                changes = [(table, key, self._snapshot(table, key)) for table, key in dict.fromkeys(self._captured)]
+                self._captured = []
+                if changes:
+                    self._seq += 1
+                    for subscriber in self._subscribers:
+                        subscriber.put((self._seq, changes))
+            return result, self._seq
+
+    def _subscribe(self, conn):
+        subscriber = queue.Queue()
+        with self._lock:
+            self._subscribers.append(subscriber)
+            conn.send(self._seq)
+        try:
+            while True:
+                conn.send(subscriber.get())
+        except (EOFError, OSError):
+            with self._lock:
+                self._subscribers.remove(subscriber)
+            conn.close()
+
+
+# 写进程客户端
+class WriterClient(object):
+
+    def __init__(self, address, authkey):
+        self.address = address
+        self.authkey = authkey
+        self._conn = Client(address, family='AF_UNIX', authkey=authkey)
+        self._conn.send('rpc')
+        self._lock = threading.Lock()
+
+    def call(self, name, *args, **kwargs):
+        """在写进程中执行写操作，返回(结果, 变更序号)"""
+        with self._lock:
+            self._conn.send((name, args, kwargs))
+            reply = self._conn.recv()
+        if reply['error'] is not None:
+            raise RuntimeError(reply['error'])
+        return reply['result'], reply['seq']
+
+    def subscribe(self):
+        """订阅变更广播，返回(连接, 订阅时的变更序号)"""
+        conn = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+        conn.send('subscribe')
+        return conn, conn.recv()
+
+
+# worker进程使用的只读副本
+class ReplicaVerification(verification):
+
+    # 等待写入同步到副本的最长时间/秒
+    APPLY_TIMEOUT = 30
+
+    def __init__(self, address, authkey):
+        """
+        读操作使用本进程内存中的副本，写操作提交给写进程执行
+        写进程广播的变更由后台线程按顺序应用到副本上
+        """
+        self.writer = WriterClient(address, authkey)
+        # 先订阅再加载数据库，加载期间产生的变更会在加载完成后重新应用(记录是完整的，重复应用无影响)
+        subscription, self._applied_seq = self.writer.subscribe()
+        self._applied = threading.Condition()
+        super().__init__(replica=True)
+        threading.Thread(target=self._follow, args=(subscription,), daemon=True).start()
+
+    def _follow(self, subscription):
+        while True:
+            try:
+                seq, changes = subscription.recv()
+            except (EOFError, OSError):
+                break
+            self.apply_changes(changes)
+            with self._applied:
+                self._applied_seq = seq
+                self._applied.notify_all()
+
+    def _remote(self, name, *args, **kwargs):
+        result, seq = self.writer.call(name, *args, **kwargs)
+        # 等待本次写入的变更应用到副本上，保证随后的读操作能读到自己的写入
+        with self._applied:
+            applied = self._applied.wait_for(lambda: self._applied_seq >= seq, timeout=self.APPLY_TIMEOUT)
+        if not applied:
+            raise TimeoutError(f'{name}: 已在写进程中执行，但{self.APPLY_TIMEOUT}秒内未同步到本进程的副本(变更序号{seq})')
+        return result
+
+
+def _remote_method(name):
+    def method(self, *args, **kwargs):
+        return self._remote(name, *args, **kwargs)
+    method.__name__ = name
+    return method
+
+
+for _name in AsyncVerification.WRITE_METHODS:
+    setattr(ReplicaVerification, _name, _remote_method(_name))
+
+
+# 保存在写进程中的session，多个worker之间共享后台管理登录状态
+class WriterSessionInterface(InMemorySessionInterface):
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # worker启动时通过connect()连接写进程
+        self.writer = None
+
+    def connect(self, address, authkey):
+        self.writer = WriterClient(address, authkey)
+
+    async def _call(self, name, *args):
+        loop = asyncio.get_running_loop()
+        result, _ = await loop.run_in_executor(None, functools.partial(self.writer.call, name, *args))
+        return result
+
+    async def _get_value(self, prefix, sid):
+        return await self._call('session_get', self.prefix + sid)
+
+    async def _delete_key(self, key):
+        await self._call('session_delete', key)
+
+    async def _set_value(self, key, data):
+        await self._call('session_set', key, data, self.expiry)
+
+
+def _run_writer(address, authkey, ready):
+    server = WriterServer(address, authkey)
+    ready.set()
+    server.serve_forever()
+
+
+def start_writer(address, authkey):
+    """启动写进程，套接字就绪后返回进程对象"""
+    if os.path.exists(address):
+        os.remove(address)
+    context = multiprocessing.get_context('fork')
+    ready = context.Event()
+    process = context.Process(target=_run_writer, args=(address, authkey, ready), name='verify-writer', daemon=True)
+    process.start()
+    while not ready.wait(0.1):
+        if not process.is_alive():
+            raise RuntimeError('写进程启动失败')
+    return process
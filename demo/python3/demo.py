@@ -1,18 +1,26 @@
 # -*- coding: UTF-8 -*-
 
+import base64
 import hashlib
 import json
 import os
+import secrets
 import subprocess
 import sys
 import time
 
 import requests
+from Crypto.Signature import eddsa
 
 sys.path.append(os.path.abspath(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))  # 或sys.path.append('../../')
 from aes_model import AEScryptor
 
 HOST = 'http://127.0.0.1:8081/'
+# 请求v2-raw格式的验证结果：PKCS7Padding填充的紧凑JSON密文，直接以二进制返回
+# 字段名缩写：c=code，m=msg，e=expireDate，t=nowtime，d=data
+RESPONSE_FORMAT = 'v2-raw'
+# 授权租约签名公钥，服务端 python3 lease_model.py 生成密钥对时输出的公钥(客户端只保存公钥，无法伪造租约)
+LEASE_PUBLIC_KEY = '更改为服务端LEASE_PRIVATE_KEY对应的公钥'
 
 
 # 获取机器码(MacOS)
@@ -47,26 +55,86 @@ def verify_machine_code(machine_code):
     # Api接口签名认证
     key = 'rrm652gz4atq7jqc'
     timestamp = str(time.time())[:10]
-    sign = hashlib.md5((machine_code + timestamp + key).encode('utf-8')).hexdigest()
-    headers = dict(timestamp=timestamp, sign=sign)
+    # 随机nonce加入签名，同一秒内多次验证也不会被服务端当作重放请求拒绝
+    nonce = secrets.token_hex(8)
+    sign = hashlib.md5((machine_code + timestamp + nonce + key).encode('utf-8')).hexdigest()
+    headers = {'timestamp': timestamp, 'nonce': nonce, 'sign': sign, 'X-Response-Format': RESPONSE_FORMAT}
 
     url = HOST + 'login'
     data = {'machineCode': machine_code}
     response = requests.request('POST', url, json=data, headers=headers)
+    if response.headers.get('Content-Type', '').startswith('application/json'):
+        # 签名错误等未加密的返回
+        return response.json()
+    key = 'vqwn3p22uics8xv8'  # 16位
+    iv = 's0Q~ioZ(AYJxyvLQ'  # 16位
+    aes = AEScryptor(key=key, iv=iv, paddingMode='PKCS7Padding', characterSet='utf-8')
+    rData = aes.decryptFromBytes(response.content)
+    # print('明文：', rData)
+    dic_str = json.loads(rData.toBytes())
+    time_ = int(time.time()) - dic_str['t']
+    if time_ > 600 or time_ < -600:
+        return '防破解时间戳校验失败'
+    else:
+        return dic_str
+
+
+# 批量机器码验证(网关代多个终端验证)
+def verify_machine_codes(machine_codes):
+    # Api接口签名认证
+    key = 'rrm652gz4atq7jqc'
+    timestamp = str(time.time())[:10]
+    nonce = secrets.token_hex(8)
+    sign = hashlib.md5((','.join(machine_codes) + timestamp + nonce + key).encode('utf-8')).hexdigest()
+    headers = {'timestamp': timestamp, 'nonce': nonce, 'sign': sign, 'X-Response-Format': RESPONSE_FORMAT}
+
+    url = HOST + 'login/batch'
+    data = {'machineCodes': machine_codes}
+    response = requests.request('POST', url, json=data, headers=headers)
+    if response.headers.get('Content-Type', '').startswith('application/json'):
+        return response.json()
+    key = 'vqwn3p22uics8xv8'  # 16位
+    iv = 's0Q~ioZ(AYJxyvLQ'  # 16位
+    aes = AEScryptor(key=key, iv=iv, paddingMode='PKCS7Padding', characterSet='utf-8')
+    rData = aes.decryptFromBytes(response.content)
+    dic_str = json.loads(rData.toBytes())
+    time_ = int(time.time()) - dic_str['t']
+    if time_ > 600 or time_ < -600:
+        return '防破解时间戳校验失败'
+    else:
+        return dic_str['d']
+
+
+# 离线校验授权租约(验证结果中的l字段)，不访问服务器
+# 签名正确、属于本机且在有效期内时返回租约内容，否则返回None(需要续期或重新验证)
+def verify_lease(lease, machine_code):
     try:
-        return json.loads(response.text)
-    except ValueError:
-        key = 'vqwn3p22uics8xv8'  # 16位
-        iv = 's0Q~ioZ(AYJxyvLQ'  # 16位
-        aes = AEScryptor(key=key, iv=iv, paddingMode='ZeroPadding', characterSet='utf-8')
-        rData = aes.decryptFromBase64(response.text)
-        # print('明文：', rData)
-        dic_str = json.loads(str(rData).replace("'", "\""))
-        time_ = int(time.time()) - dic_str['nowtime']
-        if time_ > 600 or time_ < -600:
-            return '防破解时间戳校验失败'
-        else:
-            return dic_str
+        body, signature = lease.split('.')
+        key = eddsa.import_public_key(bytes.fromhex(LEASE_PUBLIC_KEY))
+        eddsa.new(key, 'rfc8032').verify(body.encode('ascii'), base64.urlsafe_b64decode(signature + '=' * (-len(signature) % 4)))
+        payload = json.loads(base64.urlsafe_b64decode(body + '=' * (-len(body) % 4)))
+    except (AttributeError, ValueError):
+        return None
+    # m=机器码，e=授权到期时间戳，i=签发时间戳，x=租约到期时间戳
+    if payload.get('m') != machine_code or payload.get('x', 0) <= int(time.time()):
+        return None
+    return payload
+
+
+# 授权租约续期，返回新的租约，租约已撤销或已过期时返回None(需要重新调用verify_machine_code)
+def refresh_lease(lease):
+    url = HOST + 'lease/refresh'
+    response = requests.request('POST', url, json={'lease': lease})
+    result = response.json()
+    return result['lease'] if result['code'] == 10000 else None
+
+
+# 授权租约撤销列表，返回since之后撤销的{机器码摘要: 撤销时间戳}
+# 机器码摘要为hashlib.sha256(机器码).hexdigest()[:16]，签发时间不晚于撤销时间的租约已失效
+def get_lease_revocations(since=0):
+    url = HOST + 'lease/revocations'
+    response = requests.request('GET', url, params={'since': since})
+    return dict(response.json()['data'])
 
 
 # 机器码充值
@@ -85,5 +153,11 @@ if __name__ == '__main__':
     # print(reg_machine_code(get_serial_number()))
     # 机器码验证
     # print(verify_machine_code(get_serial_number()))
+    # 授权租约：验证成功后在有效期内离线校验，快到期时续期，续期失败再重新验证
+    # lease = verify_machine_code(get_serial_number())['l']
+    # print(verify_lease(lease, get_serial_number()))
+    # print(verify_lease(refresh_lease(lease), get_serial_number()))
+    # 批量机器码验证
+    # print(verify_machine_codes([get_serial_number(), 'C02XXXXXXXXX']))
     # 机器码充值
     # print(recharge_machine_code(get_serial_number(), '20220902EPEHT', 'SAVXWOQM'))
\ No newline at end of file
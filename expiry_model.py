@@ -0,0 +1,60 @@
+# -*- coding: UTF-8 -*-
+
+import bisect
+import threading
+
+
+# 按到期时间排序的用户索引
+class ExpiryIndex(object):
+
+    def __init__(self):
+        """
+        维护按(到期时间, 机器码)排序的列表，到期时间范围查询和计数都是二分查找，不扫描用户表
+        到期时间可以是'%Y-%m-%d %H:%M:%S'字符串或整数时间戳，同一索引内类型一致即可
+        """
+        self._entries = []
+        # machine_code -> 到期时间
+        self._expire_dates = {}
+        self._lock = threading.Lock()
+
+    def build(self, users):
+        """用全部用户重建索引"""
+        expire_dates = {user['machine_code']: user['expire_date'] for user in users}
+        entries = sorted((expire_date, machine_code) for machine_code, expire_date in expire_dates.items())
+        with self._lock:
+            self._expire_dates = expire_dates
+            self._entries = entries
+
+    def update(self, machine_code, expire_date):
+        """更新一个用户的到期时间，expire_date为None表示用户已删除"""
+        with self._lock:
+            old = self._expire_dates.pop(machine_code, None)
+            if old is not None:
+                i = bisect.bisect_left(self._entries, (old, machine_code))
+                if i < len(self._entries) and self._entries[i] == (old, machine_code):
+                    del self._entries[i]
+            if expire_date is not None:
+                self._expire_dates[machine_code] = expire_date
+                bisect.insort(self._entries, (expire_date, machine_code))
+
+    def _bounds(self, start, end):
+        # (start,)小于所有(start, 机器码)，(end,)同理，即 start <= 到期时间 < end
+        lo = 0 if start is None else bisect.bisect_left(self._entries, (start,))
+        hi = len(self._entries) if end is None else bisect.bisect_left(self._entries, (end,))
+        return lo, max(lo, hi)
+
+    def range(self, start=None, end=None, limit=None):
+        """返回 start <= 到期时间 < end 的[(到期时间, 机器码), ...]，按到期时间升序，None为不限"""
+        with self._lock:
+            lo, hi = self._bounds(start, end)
+            if limit is not None:
+                hi = min(hi, lo + limit)
+            return self._entries[lo:hi]
+
+    def count(self, start=None, end=None):
+        with self._lock:
+            lo, hi = self._bounds(start, end)
+            return hi - lo
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,120 @@
+# -*- coding: UTF-8 -*-
+
+import base64
+import functools
+import hashlib
+import json
+import os
+import threading
+
+from Crypto.PublicKey import ECC
+from Crypto.Signature import eddsa
+
+# 租约格式：base64url(紧凑JSON).base64url(Ed25519签名)，不含'='
+# 服务端持有私钥签发，客户端只内置公钥，拿到公钥也无法伪造租约
+# JSON字段：v=格式版本，m=机器码，e=授权到期时间戳，i=签发时间戳，x=租约到期时间戳(不晚于e)
+LEASE_VERSION = 2
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+@functools.lru_cache(maxsize=4)
+def _private_key(private_key):
+    """private_key: 64位十六进制的Ed25519私钥种子，格式错误时抛出ValueError"""
+    seed = bytes.fromhex(private_key)
+    if len(seed) != 32:
+        raise ValueError('Ed25519私钥应为64位十六进制')
+    return ECC.construct(curve='Ed25519', seed=seed)
+
+
+def public_key(private_key):
+    """私钥对应的公钥，64位十六进制，写入客户端用于离线校验"""
+    return _private_key(private_key).public_key().export_key(format='raw').hex()
+
+
+def encode_lease(private_key, machine_code, expire_date, issued_at, ttl):
+    """签发租约，ttl: 租约有效期/秒"""
+    payload = {'v': LEASE_VERSION, 'm': machine_code, 'e': expire_date, 'i': issued_at, 'x': min(issued_at + ttl, expire_date)}
+    body = _b64encode(json.dumps(payload, ensure_ascii=False, separators=(',', ':'), sort_keys=True).encode('utf-8'))
+    signature = eddsa.new(_private_key(private_key), 'rfc8032').sign(body.encode('ascii'))
+    return body + '.' + _b64encode(signature)
+
+
+def decode_lease(private_key, lease):
+    """用私钥对应的公钥校验签名并返回租约内容，格式或签名错误时返回None，不检查是否过期"""
+    if not isinstance(lease, str) or lease.count('.') != 1:
+        return None
+    body, signature = lease.split('.')
+    try:
+        eddsa.new(_private_key(private_key).public_key(), 'rfc8032').verify(body.encode('ascii'), _b64decode(signature))
+        payload = json.loads(_b64decode(body))
+    except (ValueError, UnicodeError):
+        return None
+    if not isinstance(payload, dict) or payload.get('v') != LEASE_VERSION:
+        return None
+    return payload
+
+
+def machine_code_digest(machine_code):
+    """撤销列表中代替机器码的摘要(不公开机器码)"""
+    return hashlib.sha256(machine_code.encode('utf-8')).hexdigest()[:16]
+
+
+# 租约撤销列表
+class RevocationList(object):
+
+    def __init__(self, max_age):
+        """
+        记录机器码最后一次撤销的时间，在此之前(含同一秒)签发的租约都失效
+        超过max_age秒的记录对应的租约都已无法刷新，清理掉以保持列表紧凑
+        max_age: 记录保留时间/秒
+        """
+        self.max_age = max_age
+        # machine_code -> 撤销时间戳
+        self._revoked = {}
+        self._lock = threading.Lock()
+
+    def revoke(self, machine_code, revoked_at):
+        with self._lock:
+            if revoked_at > self._revoked.get(machine_code, 0):
+                self._revoked[machine_code] = revoked_at
+            self._purge(revoked_at)
+
+    def _purge(self, now):
+        expired = [machine_code for machine_code, revoked_at in self._revoked.items() if revoked_at < now - self.max_age]
+        for machine_code in expired:
+            del self._revoked[machine_code]
+
+    def get(self, machine_code):
+        """返回撤销时间戳，没有记录时返回None"""
+        return self._revoked.get(machine_code)
+
+    def is_revoked(self, machine_code, issued_at):
+        revoked_at = self._revoked.get(machine_code)
+        return revoked_at is not None and revoked_at >= issued_at
+
+    def since(self, timestamp, now):
+        """timestamp之后(含)的撤销记录[[机器码摘要, 撤销时间戳], ...]，按时间升序"""
+        with self._lock:
+            self._purge(now)
+            return sorted(
+                ([machine_code_digest(machine_code), revoked_at] for machine_code, revoked_at in self._revoked.items() if revoked_at >= timestamp),
+                key=lambda item: item[1]
+            )
+
+    def __len__(self):
+        return len(self._revoked)
+
+
+if __name__ == '__main__':
+    # 生成一对新的租约签名密钥：私钥写入.env的LEASE_PRIVATE_KEY，公钥写入客户端
+    # python3 lease_model.py
+    new_private_key = os.urandom(32).hex()
+    print('LEASE_PRIVATE_KEY=' + new_private_key)
+    print('公钥：' + public_key(new_private_key))
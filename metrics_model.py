@@ -0,0 +1,134 @@
+# -*- coding: UTF-8 -*-
+
+import bisect
+import math
+
+# 默认的耗时分桶/秒
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# 计数器
+class Counter(object):
+
+    type = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        # 标签值元组 -> 计数
+        self._values = {}
+
+    def inc(self, *labels, value=1):
+        self._values[labels] = self._values.get(labels, 0) + value
+
+    def samples(self):
+        for labels, value in list(self._values.items()):
+            yield self.name, _labels(self.labelnames, labels), value
+
+
+# 直方图
+class Histogram(object):
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # 标签值元组 -> [各分桶计数(不累计，最后一个为+Inf), 总和]
+        self._values = {}
+
+    def observe(self, value, *labels):
+        item = self._values.get(labels)
+        if item is None:
+            item = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        item[0][bisect.bisect_left(self.buckets, value)] += 1
+        item[1] += value
+
+    def samples(self):
+        for labels, (counts, total) in list(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield f'{self.name}_bucket', _labels(self.labelnames, labels, f'le="{_number(bound)}"'), cumulative
+            yield f'{self.name}_sum', _labels(self.labelnames, labels), total
+            yield f'{self.name}_count', _labels(self.labelnames, labels), cumulative
+
+
+# 仪表，采集时调用函数取值
+class Gauge(object):
+
+    def __init__(self, name, help, labelnames=(), collect=None, type='gauge'):
+        """
+        collect: 返回[(标签值元组, 数值), ...]的函数
+        type: 取值只增不减时(如其他对象中维护的累计次数)可设为counter
+        """
+        self.type = type
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.collect = collect
+
+    def samples(self):
+        for labels, value in self.collect():
+            yield self.name, _labels(self.labelnames, labels), value
+
+
+# 指标注册表
+class Registry(object):
+
+    def __init__(self):
+        """
+        记录只做字典查找和整数加法，不加锁：所有记录都在事件循环线程中进行
+        多进程模式下每个worker各自统计
+        """
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Prometheus文本格式"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HTTP_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'http_request_duration_seconds', '请求处理耗时', ('route', 'method')
+))
+HTTP_REQUESTS = REGISTRY.register(Counter(
+    'http_requests_total', '请求数，按HTTP状态码和返回结果code统计', ('route', 'status', 'code')
+))
+HTTP_ERRORS = REGISTRY.register(Counter(
+    'http_errors_total', 'HTTP状态码>=500的请求数', ('route',)
+))
+STORAGE_SECONDS = REGISTRY.register(Histogram(
+    'storage_operation_seconds', '数据读写方法耗时(含线程池排队)', ('operation', 'kind')
+))
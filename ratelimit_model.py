@@ -0,0 +1,79 @@
+# -*- coding: UTF-8 -*-
+
+import time
+from collections import OrderedDict
+
+
+# 令牌桶限流
+class TokenBucketLimiter(object):
+
+    def __init__(self, rate, burst, maxsize=100000):
+        """
+        每个key一个令牌桶，按rate每秒恢复令牌，最多保存burst个
+        桶按最近访问顺序保存，空闲到令牌恢复满的桶和删除等价，访问时顺带从最久未访问的一端清理，超过maxsize时淘汰最久未访问的桶
+        只在事件循环线程中调用，不加锁
+        rate: 每秒恢复的令牌数
+        burst: 令牌桶容量(允许的突发请求数)
+        maxsize: 最多保存的桶数
+        """
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._idle = burst / rate
+        # key -> [剩余令牌数, 上次访问时间]
+        self._buckets = OrderedDict()
+
+    def acquire(self, key, cost=1):
+        """消耗cost个令牌，成功返回0，令牌不足时返回需要等待的秒数"""
+        now = time.monotonic()
+        item = self._buckets.get(key)
+        if item is None:
+            item = self._buckets[key] = [self.burst, now]
+        else:
+            item[0] = min(self.burst, item[0] + (now - item[1]) * self.rate)
+            item[1] = now
+            self._buckets.move_to_end(key)
+        self._evict(now)
+        if item[0] < cost:
+            return (cost - item[0]) / self.rate
+        item[0] -= cost
+        return 0
+
+    def _evict(self, now):
+        buckets = self._buckets
+        while buckets:
+            item = buckets[next(iter(buckets))]
+            if len(buckets) <= self.maxsize and now - item[1] < self._idle:
+                break
+            buckets.popitem(last=False)
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+# 并发数限制
+class ConcurrencyLimiter(object):
+
+    def __init__(self, limit, reserved=0.2):
+        """
+        同时处理的请求数达到上限后直接拒绝新请求(过载保护)
+        低优先级请求只能使用limit*(1-reserved)个名额，剩余名额留给高优先级请求
+        limit: 最大并发数，0为不限制(仍然统计并发数)
+        reserved: 为高优先级请求保留的比例
+        """
+        self.limit = limit
+        self.low_limit = limit - int(limit * reserved)
+        # 正在处理的请求数及被拒绝的请求数
+        self.active = 0
+        self.shed = 0
+
+    def acquire(self, priority=False):
+        """成功返回True，之后必须调用release()"""
+        if self.limit and self.active >= (self.limit if priority else self.low_limit):
+            self.shed += 1
+            return False
+        self.active += 1
+        return True
+
+    def release(self):
+        self.active -= 1
@@ -0,0 +1,33 @@
+# -*- coding: UTF-8 -*-
+
+import json
+
+# 请求头X-Response-Format选择加密返回数据的格式，不传时使用旧格式
+# v1: str(dict)的Python字典文本，ZeroPadding填充，base64文本返回
+# v2: 短字段名的紧凑JSON，PKCS7Padding填充，base64文本返回
+# v2-raw: 同v2，直接返回密文字节(application/octet-stream)
+RESPONSE_FORMAT_HEADER = 'X-Response-Format'
+RESPONSE_FORMATS = ('v1', 'v2', 'v2-raw')
+# v2格式的字段名缩写
+COMPACT_KEYS = {'code': 'c', 'msg': 'm', 'expireDate': 'e', 'nowtime': 't', 'data': 'd', 'lease': 'l'}
+
+
+def get_response_format(request):
+    """返回请求使用的格式，未知的格式按v1处理"""
+    response_format = request.headers.get(RESPONSE_FORMAT_HEADER, 'v1').lower()
+    return response_format if response_format in RESPONSE_FORMATS else 'v1'
+
+
+def compact_result(result):
+    """字段名替换为缩写，批量验证结果中data的每一项同样替换"""
+    compacted = {}
+    for key, value in result.items():
+        if key == 'data' and isinstance(value, dict):
+            value = {name: compact_result(item) for name, item in value.items()}
+        compacted[COMPACT_KEYS.get(key, key)] = value
+    return compacted
+
+
+def dumps_compact(result):
+    """按键排序、无空白的UTF-8 JSON字节"""
+    return json.dumps(compact_result(result), ensure_ascii=False, separators=(',', ':'), sort_keys=True).encode('utf-8')
@@ -0,0 +1,101 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import threading
+from pathlib import Path
+
+from dotenv import find_dotenv, load_dotenv
+
+
+def parse_bool(value):
+    """解析布尔值字符串，取值与distutils.util.strtobool一致，非法时抛出ValueError"""
+    value = value.strip().lower()
+    if value in ('y', 'yes', 't', 'true', 'on', '1'):
+        return True
+    if value in ('n', 'no', 'f', 'false', 'off', '0'):
+        return False
+    raise ValueError(f'非法的布尔值: {value!r}')
+
+
+# 配置快照
+class Settings(object):
+
+    # 不在后台展示的配置
+    SECRETS = ('admin_pass', 'lease_private_key', 'metrics_token')
+    # 修改后需要重启服务才能生效的配置
+    RESTART_REQUIRED = (
+        'host', 'port', 'workers', 'auto_reload', 'db_backend', 'sqlite_path', 'db_storage', 'login_cache_size', 'login_cache_ttl',
+        'replay_window', 'replay_cache_size', 'proxies_count', 'ip_rate', 'ip_burst', 'machine_rate', 'machine_burst',
+        'rate_limit_table_size', 'max_concurrency', 'lease_ttl',
+    )
+
+    def __init__(self, env):
+        """
+        从环境变量解析出的只读配置，格式错误时抛出ValueError
+        env: 环境变量字典
+        """
+        self.host = env.get('HOST', '127.0.0.1')
+        self.port = int(env.get('PORT', '8081'))
+        self.proxies_count = int(env.get('PROXIES_COUNT', '0'))
+        self.workers = int(env.get('WORKERS', '1'))
+        self.debug = parse_bool(env.get('DEBUG', 'False'))
+        self.auto_reload = parse_bool(env.get('AUTO_RELOAD', 'False'))
+        self.admin_user = env.get('ADMIN_USER', '')
+        self.admin_pass = env.get('ADMIN_PASS', '')
+        self.network_auth = parse_bool(env.get('NETWORK_AUTH', 'True'))
+        self.is_trial = parse_bool(env.get('IS_TRIAL', 'False'))
+        # 试用时间/秒
+        self.trial_seconds = int(env.get('TRIAL_TIME', '0')) * 60
+        self.db_backend = env.get('DB_BACKEND', 'tinydb').lower()
+        self.sqlite_path = env.get('SQLITE_PATH', './database/db.sqlite3')
+        self.db_storage = env.get('DB_STORAGE', 'json').lower()
+        self.login_cache_size = int(env.get('LOGIN_CACHE_SIZE', '100000'))
+        self.login_cache_ttl = int(env.get('LOGIN_CACHE_TTL', '300'))
+        self.replay_window = int(env.get('REPLAY_WINDOW', '300'))
+        self.replay_cache_size = int(env.get('REPLAY_CACHE_SIZE', '200000'))
+        self.rate_limit = parse_bool(env.get('RATE_LIMIT', 'True'))
+        self.ip_rate = float(env.get('IP_RATE', '10'))
+        self.ip_burst = float(env.get('IP_BURST', '50'))
+        self.machine_rate = float(env.get('MACHINE_RATE', '1'))
+        self.machine_burst = float(env.get('MACHINE_BURST', '20'))
+        self.rate_limit_table_size = int(env.get('RATE_LIMIT_TABLE_SIZE', '100000'))
+        # 令牌桶的恢复速率和容量必须大于0，关闭限流使用RATE_LIMIT=False
+        for name in ('ip_rate', 'ip_burst', 'machine_rate', 'machine_burst'):
+            if not getattr(self, name) > 0:
+                raise ValueError(f'{name.upper()}必须大于0')
+        self.max_concurrency = int(env.get('MAX_CONCURRENCY', '256'))
+        self.lease_private_key = env.get('LEASE_PRIVATE_KEY', '').strip().lower()
+        if self.lease_private_key and len(bytes.fromhex(self.lease_private_key)) != 32:
+            raise ValueError('LEASE_PRIVATE_KEY应为64位十六进制')
+        self.lease_ttl = int(env.get('LEASE_TTL', '600'))
+        self.metrics_token = env.get('METRICS_TOKEN', '')
+
+    def public(self):
+        """不含密码和密钥的配置，用于后台展示"""
+        return {name: value for name, value in vars(self).items() if name not in self.SECRETS}
+
+
+# 当前配置
+class SettingsStore(object):
+
+    def __init__(self):
+        """
+        启动时解析一次.env，之后读取current不再访问环境变量
+        reload()重新读取.env并整体替换current，请求中读到的始终是某一个完整的快照
+        """
+        self._lock = threading.Lock()
+        self.current = self._load(override=False)
+
+    @staticmethod
+    def _load(override):
+        load_dotenv(find_dotenv(str(Path.cwd().joinpath('.env'))), override=override)
+        return Settings(os.environ)
+
+    def reload(self):
+        """重新读取.env，格式错误时抛出ValueError并保留原配置，返回新配置"""
+        with self._lock:
+            self.current = self._load(override=True)
+            return self.current
+
+
+settings = SettingsStore()
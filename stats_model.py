@@ -0,0 +1,113 @@
+# -*- coding: UTF-8 -*-
+
+import bisect
+import threading
+
+
+# 后台概览统计
+class DashboardStats(object):
+
+    USER_GROUPS = ('app_category', 'aes_config_id')
+
+    def __init__(self):
+        """
+        随每次数据变更增量维护的计数，查询时不读取数据库
+        用户按应用分类和AES配置分组，每组保存有序的到期时间列表，有效/过期数量按当前时间二分得到
+        充值卡按天数分组统计已使用和未使用数量
+        """
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # machine_code -> (app_category, aes_config_id, expire_date)
+        self._users = {}
+        # 分组字段 -> {分组值: 有序的到期时间列表}
+        self._groups = {name: {} for name in self.USER_GROUPS}
+        self._expire_dates = []
+        # card_number -> (days, used)
+        self._cards = {}
+        # days -> [未使用数量, 已使用数量]
+        self._card_counts = {}
+
+    def build(self, users, cards):
+        """用全部用户和充值卡重建统计"""
+        # 先收集再整体排序，避免逐条insort
+        user_keys = {user['machine_code']: self._user_key(user) for user in users}
+        card_keys = {card['card_number']: (card['days'], int(bool(card.get('used')))) for card in cards}
+        groups = {name: {} for name in self.USER_GROUPS}
+        for key in user_keys.values():
+            for name, value in zip(self.USER_GROUPS, key):
+                groups[name].setdefault(value, []).append(key[2])
+        for values in groups.values():
+            for expire_dates in values.values():
+                expire_dates.sort()
+        card_counts = {}
+        for days, used in card_keys.values():
+            card_counts.setdefault(days, [0, 0])[used] += 1
+        with self._lock:
+            self._users = user_keys
+            self._groups = groups
+            self._expire_dates = sorted(key[2] for key in user_keys.values())
+            self._cards = card_keys
+            self._card_counts = card_counts
+
+    @staticmethod
+    def _user_key(user):
+        return user.get('app_category', '') or '', user.get('aes_config_id') or 'default', user['expire_date']
+
+    @staticmethod
+    def _remove_value(values, value):
+        i = bisect.bisect_left(values, value)
+        if i < len(values) and values[i] == value:
+            del values[i]
+
+    def update_user(self, machine_code, user):
+        """用户新增、修改或删除(user为None)后调用"""
+        with self._lock:
+            old = self._users.pop(machine_code, None)
+            if old is not None:
+                for name, value in zip(self.USER_GROUPS, old):
+                    values = self._groups[name][value]
+                    self._remove_value(values, old[2])
+                    if not values:
+                        del self._groups[name][value]
+                self._remove_value(self._expire_dates, old[2])
+            if user is not None:
+                new = self._user_key(user)
+                self._users[machine_code] = new
+                for name, value in zip(self.USER_GROUPS, new):
+                    bisect.insort(self._groups[name].setdefault(value, []), new[2])
+                bisect.insort(self._expire_dates, new[2])
+
+    def update_card(self, card_number, card):
+        """充值卡新增、修改或删除(card为None)后调用"""
+        with self._lock:
+            old = self._cards.pop(card_number, None)
+            if old is not None:
+                counts = self._card_counts[old[0]]
+                counts[old[1]] -= 1
+                if not any(counts):
+                    del self._card_counts[old[0]]
+            if card is not None:
+                new = (card['days'], int(bool(card.get('used'))))
+                self._cards[card_number] = new
+                self._card_counts.setdefault(new[0], [0, 0])[new[1]] += 1
+
+    @staticmethod
+    def _user_counts(expire_dates, now):
+        expired = bisect.bisect_right(expire_dates, now)
+        return {'total': len(expire_dates), 'active': len(expire_dates) - expired, 'expired': expired}
+
+    def snapshot(self, now):
+        """now: 当前时间戳，到期时间大于now的用户为有效用户"""
+        with self._lock:
+            return {
+                'users': self._user_counts(self._expire_dates, now),
+                **{name: {value: self._user_counts(values, now) for value, values in groups.items()} for name, groups in self._groups.items()},
+                'cards': {
+                    'total': len(self._cards),
+                    'used': sum(counts[1] for counts in self._card_counts.values()),
+                    'unused': sum(counts[0] for counts in self._card_counts.values()),
+                },
+                'cards_by_days': {days: {'used': counts[1], 'unused': counts[0]} for days, counts in sorted(self._card_counts.items())},
+            }
@@ -0,0 +1,898 @@
+# -*- coding: UTF-8 -*-
+
+import bisect
+import copy
+import json
+import os
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
+
+from tinydb import Query, TinyDB
+from tinydb.middlewares import CachingMiddleware
+from tinydb.storages import JSONStorage, MemoryStorage, Storage, touch
+
+from clock_model import parse_time
+
+# 保存为整数时间戳的时间字段
+USER_TIME_FIELDS = ('expire_date', 'reg_date')
+CARD_TIME_FIELDS = ('used_time',)
+
+
+def load_database(path, encoding='utf-8'):
+    """
+    读取db.json快照，并按顺序重放WAL日志(.wal.old为上次未完成合并时残留的日志)
+    返回(数据, 重放的日志记录数)，不修改任何文件
+    """
+    with open(path, 'r', encoding=encoding) as f:
+        content = f.read()
+    data = json.loads(content) if content.strip() else {}
+    replayed = _replay_log(data, path + '.wal.old', encoding) + _replay_log(data, path + '.wal', encoding)
+    return data, replayed
+
+
+def _replay_log(data, log_path, encoding):
+    """重放日志文件，返回重放的记录数，遇到不完整的行(写入中断)即停止"""
+    if not os.path.exists(log_path):
+        return 0
+    count = 0
+    with open(log_path, 'r', encoding=encoding) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            name = record['t']
+            if 'id' not in record:
+                data.pop(name, None)
+            elif 'd' in record:
+                data.setdefault(name, {})[record['id']] = record['d']
+            else:
+                data.get(name, {}).pop(record['id'], None)
+            count += 1
+    return count
+
+
+# 追加写日志(WAL)存储引擎
+class WALStorage(Storage):
+
+    def __init__(self, path, create_dirs=False, encoding='utf-8', compact_size=4 * 1024 * 1024, sync=False, **kwargs):
+        """
+        TinyDB存储引擎，每次写入只把发生变化的记录追加到日志文件，而不是重写整个数据库文件
+        path: 快照文件路径，格式与JSONStorage一致，日志文件为 path + '.wal'
+        compact_size: 日志文件超过该字节数后在后台线程合并为新的快照
+        sync: 每条日志写入后是否调用fsync
+        kwargs: 写快照时传给json.dump的参数(如indent)
+        """
+        self.path = path
+        self.log_path = path + '.wal'
+        self.old_log_path = path + '.wal.old'
+        self.encoding = encoding
+        self.compact_size = compact_size
+        self.sync = sync
+        self.kwargs = kwargs
+        self._lock = threading.Lock()
+        self._compactor = None
+        # 下一次写入修改的(表名, doc_id集合)，由TinyDBBackend在写入前设置
+        self._hint = None
+        touch(path, create_dirs=create_dirs)
+
+        self._data, replayed = load_database(path, encoding)
+        # 已落盘状态的副本，写入时与之比较得出变化的记录
+        self._shadow = copy.deepcopy(self._data)
+        # 各表dict对象，TinyDB只替换被修改的表，未被替换的表无需比较
+        self._tables = dict(self._data)
+        if replayed:
+            # 启动时直接合并，之后从空日志开始
+            self._write_snapshot(self._shadow)
+            for log_path in (self.old_log_path, self.log_path):
+                if os.path.exists(log_path):
+                    os.remove(log_path)
+        self._log = open(self.log_path, 'a', encoding=self.encoding)
+        self._log_size = self._log.tell()
+
+    def hint(self, name, doc_ids):
+        """
+        声明下一次写入只修改或删除了name表中的doc_ids，新增的记录由TinyDB追加在表的末尾
+        写入时只比较这些记录，不再比较整张表，name为None时清除
+        """
+        self._hint = None if name is None else (name, {str(doc_id) for doc_id in doc_ids})
+
+    def _diff_hinted(self, name, table, doc_ids, records):
+        shadow = self._shadow[name]
+        for doc_id in doc_ids:
+            doc = table.get(doc_id)
+            if doc is None:
+                if shadow.pop(doc_id, None) is not None:
+                    records.append({'t': name, 'id': doc_id})
+            elif shadow.get(doc_id) != doc:
+                shadow[doc_id] = copy.deepcopy(doc)
+                records.append({'t': name, 'id': doc_id, 'd': doc})
+        # 从末尾向前找出新增的记录，遇到已落盘的记录即停止
+        inserted = []
+        for doc_id in reversed(table.keys()):
+            if doc_id in shadow:
+                break
+            inserted.append(doc_id)
+        for doc_id in reversed(inserted):
+            shadow[doc_id] = copy.deepcopy(table[doc_id])
+            records.append({'t': name, 'id': doc_id, 'd': table[doc_id]})
+
+    def _diff(self, data, hint=None):
+        """
+        比较TinyDB写回的数据与已落盘状态，生成日志记录并同步更新已落盘状态
+        hint: hint()设置的(表名, doc_id集合)，该表只比较其中的记录和新增的记录，其余被替换的表比较全部记录
+        """
+        records = []
+        for name in list(self._shadow):
+            if name not in data:
+                del self._shadow[name]
+                records.append({'t': name})
+        for name, table in data.items():
+            if self._tables.get(name) is table:
+                continue
+            if hint is not None and hint[0] == name and name in self._shadow:
+                self._diff_hinted(name, table, hint[1], records)
+                continue
+            shadow = self._shadow.setdefault(name, {})
+            for doc_id, doc in table.items():
+                if shadow.get(doc_id) != doc:
+                    shadow[doc_id] = copy.deepcopy(doc)
+                    records.append({'t': name, 'id': doc_id, 'd': doc})
+            for doc_id in shadow.keys() - table.keys():
+                del shadow[doc_id]
+                records.append({'t': name, 'id': doc_id})
+        self._tables = dict(data)
+        return records
+
+    def read(self):
+        return self._data
+
+    def write(self, data):
+        with self._lock:
+            self._data = data
+            hint, self._hint = self._hint, None
+            records = self._diff(data, hint)
+            if not records:
+                return
+            lines = ''.join(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n' for record in records)
+            self._log.write(lines)
+            self._log.flush()
+            if self.sync:
+                os.fsync(self._log.fileno())
+            self._log_size += len(lines)
+            if self._log_size >= self.compact_size and self._compactor is None:
+                self._start_compaction()
+
+    def _start_compaction(self):
+        """切换到新日志文件，并在后台线程把当前状态写成快照"""
+        self._log.close()
+        os.replace(self.log_path, self.old_log_path)
+        self._log = open(self.log_path, 'a', encoding=self.encoding)
+        self._log_size = 0
+        # _shadow中的文档只会被整体替换而不会被原地修改，浅拷贝即可得到一致的快照
+        snapshot = {name: dict(table) for name, table in self._shadow.items()}
+        self._compactor = threading.Thread(target=self._compact, args=(snapshot,), daemon=True)
+        self._compactor.start()
+
+    def _compact(self, snapshot):
+        # 合并失败时保留_compactor，不再发起新的合并，避免覆盖尚未合并的.wal.old
+        self._write_snapshot(snapshot)
+        os.remove(self.old_log_path)
+        self._compactor = None
+
+    def _write_snapshot(self, snapshot):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding=self.encoding) as f:
+            json.dump(snapshot, f, **self.kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+        self._log.close()
+
+
+# 只读副本存储
+class ReplicaStorage(MemoryStorage):
+
+    def __init__(self, path, encoding='utf-8', **kwargs):
+        """
+        多进程模式下worker使用的存储，启动时加载快照并重放日志
+        之后由写进程广播的变更只应用在内存中，不写回文件
+        """
+        super().__init__()
+        self.memory, _ = load_database(path, encoding)
+
+
+# 写穿透读缓存
+class WriteThroughCache(CachingMiddleware):
+    """
+    读操作直接返回内存中的数据，不再每次读取并解析整个数据库文件
+    每次写入立即落盘(CachingMiddleware默认攒够1000次写入才落盘)，缓存与文件始终一致
+    """
+    WRITE_CACHE_SIZE = 1
+
+
+# TinyDB数据后端
+class TinyDBBackend(object):
+
+    def __init__(self, path, storage='json'):
+        """
+        基于TinyDB的数据后端，用户表和充值卡表维护内存索引，按主键查询无需全表扫描
+        path: 数据库文件路径
+        storage: json=JSONStorage(每次写入重写整个文件，读操作走内存缓存)，wal=WALStorage，replica=ReplicaStorage
+        所有表共用同一个TinyDB实例和存储对象
+        """
+        self.path = path
+        if storage == 'wal':
+            self.db = TinyDB(path, storage=WALStorage, indent=4)
+        elif storage == 'replica':
+            self.db = TinyDB(path, storage=ReplicaStorage)
+        else:
+            self.db = TinyDB(path, storage=WriteThroughCache(JSONStorage), indent=4)
+        self.users = self.db.table('user')
+        self.cards = self.db.table('card')
+        self.app_categories = self.db.table('app_categories')
+        self.aes_configs = self.db.table('aes_configs')
+        self._lock = threading.RLock()
+        # machine_code -> doc_id
+        self._user_index = {}
+        for user in self.users.all():
+            self._user_index.setdefault(user.get('machine_code'), user.doc_id)
+        # card_number -> doc_id
+        self._card_index = {}
+        for card in self.cards.all():
+            self._card_index.setdefault(card.get('card_number'), card.doc_id)
+        # 有序的doc_id列表，用于按游标分页，长度即为记录数
+        self._user_ids = sorted(self._user_index.values())
+        self._card_ids = sorted(card.doc_id for card in self.cards.all())
+        self._migrate_epoch()
+
+    def _migrate_epoch(self):
+        """旧版本的时间字段保存为'%Y-%m-%d %H:%M:%S'字符串，启动时一次性转换为整数时间戳(每张表一次写入)"""
+        for table, fields in ((self.users, USER_TIME_FIELDS), (self.cards, CARD_TIME_FIELDS)):
+            doc_ids = [doc.doc_id for doc in table if any(isinstance(doc.get(name), str) for name in fields)]
+            if not doc_ids:
+                continue
+
+            def convert(doc, fields=fields):
+                for name in fields:
+                    if isinstance(doc.get(name), str):
+                        doc[name] = parse_time(doc[name])
+
+            with self._hint(table, doc_ids):
+                table.update(convert, doc_ids=doc_ids)
+
+    @contextmanager
+    def _hint(self, table, doc_ids=()):
+        """WAL存储引擎下声明块内的一次写入修改的记录，其他存储引擎忽略；写入失败时清除，不影响之后的写入"""
+        hint = getattr(self.db.storage, 'hint', None)
+        if hint is None:
+            yield
+            return
+        hint(table.name, doc_ids)
+        try:
+            yield
+        finally:
+            hint(None, ())
+
+    @contextmanager
+    def transaction(self):
+        """TinyDB不支持事务，这里只保证块内的多次写入不与其他线程交错"""
+        with self._lock:
+            yield
+
+    @staticmethod
+    def _discard_id(ids, doc_id):
+        i = bisect.bisect_left(ids, doc_id)
+        if i < len(ids) and ids[i] == doc_id:
+            del ids[i]
+
+    def _page(self, table, ids, limit, before, after):
+        """
+        按doc_id从新到旧分页，只读取本页的记录
+        before: 取id小于before的limit条(下一页)
+        after: 取id大于after的limit条(上一页)，不足limit条时返回第一页；after=0为最后一页
+        都为None时返回第一页
+        返回 ([(id, 记录), ...], 是否有更早的记录, 是否有更新的记录)
+        """
+        with self._lock:
+            if after is not None:
+                start = bisect.bisect_right(ids, after)
+                end = start + limit
+                if end > len(ids):
+                    end = len(ids)
+                    start = max(end - limit, 0)
+            else:
+                end = len(ids) if before is None else bisect.bisect_left(ids, before)
+                start = max(end - limit, 0)
+            page_ids = ids[start:end]
+            has_older, has_newer = start > 0, end < len(ids)
+        rows = [(doc_id, table.get(doc_id=doc_id)) for doc_id in reversed(page_ids)]
+        return [(doc_id, doc) for doc_id, doc in rows if doc is not None], has_older, has_newer
+
+    # 用户(机器码)
+    def find_user(self, machine_code):
+        doc_id = self._user_index.get(machine_code)
+        if doc_id is None:
+            return None
+        return self.users.get(doc_id=doc_id)
+
+    def insert_user(self, user):
+        with self._lock:
+            if user['machine_code'] in self._user_index:
+                return False
+            with self._hint(self.users):
+                doc_id = self.users.insert(user)
+            self._user_index[user['machine_code']] = doc_id
+            bisect.insort(self._user_ids, doc_id)
+            return True
+
+    def insert_users(self, users):
+        """批量插入用户(一次写入)，跳过已存在的机器码，返回插入的数量"""
+        with self._lock:
+            users = [user for user in users if user['machine_code'] not in self._user_index]
+            with self._hint(self.users):
+                doc_ids = self.users.insert_multiple(users)
+            for doc_id, user in zip(doc_ids, users):
+                self._user_index[user['machine_code']] = doc_id
+                bisect.insort(self._user_ids, doc_id)
+            return len(doc_ids)
+
+    def update_user(self, machine_code, fields):
+        with self._lock:
+            doc_id = self._user_index.get(machine_code)
+            if doc_id is None:
+                return False
+            with self._hint(self.users, [doc_id]):
+                return len(self.users.update(fields, doc_ids=[doc_id])) == 1
+
+    def update_users_where(self, field, value, fields):
+        """更新所有field == value的用户，返回被更新用户的machine_code列表"""
+        with self._lock:
+            users = self.users.search(Query()[field] == value)
+            doc_ids = [user.doc_id for user in users]
+            with self._hint(self.users, doc_ids):
+                self.users.update(fields, doc_ids=doc_ids)
+            return [user['machine_code'] for user in users]
+
+    def remove_user(self, machine_code):
+        with self._lock:
+            doc_id = self._user_index.pop(machine_code, None)
+            if doc_id is None:
+                return False
+            self._discard_id(self._user_ids, doc_id)
+            with self._hint(self.users, [doc_id]):
+                return len(self.users.remove(doc_ids=[doc_id])) == 1
+
+    def remove_users(self, machine_codes):
+        """批量删除用户(一次写入)，返回实际删除的machine_code列表"""
+        with self._lock:
+            removed = [machine_code for machine_code in machine_codes if machine_code in self._user_index]
+            doc_ids = [self._user_index.pop(machine_code) for machine_code in removed]
+            for doc_id in doc_ids:
+                self._discard_id(self._user_ids, doc_id)
+            if doc_ids:
+                with self._hint(self.users, doc_ids):
+                    self.users.remove(doc_ids=doc_ids)
+            return removed
+
+    def all_users(self):
+        return self.users.all()
+
+    def iter_users(self):
+        """按插入顺序逐条返回用户，写入时表数据整体替换(写时复制)，迭代期间的写入不影响本次迭代"""
+        return iter(self.users)
+
+    def page_users(self, limit, before=None, after=None):
+        """按doc_id倒序分页，参数和返回值见_page()"""
+        return self._page(self.users, self._user_ids, limit, before, after)
+
+    def count_users(self):
+        return len(self._user_ids)
+
+    # 充值卡
+    def find_card(self, card_number):
+        doc_id = self._card_index.get(card_number)
+        if doc_id is None:
+            return None
+        return self.cards.get(doc_id=doc_id)
+
+    def insert_cards(self, cards):
+        with self._lock:
+            with self._hint(self.cards):
+                doc_ids = self.cards.insert_multiple(cards)
+            for doc_id, card in zip(doc_ids, cards):
+                self._card_index.setdefault(card['card_number'], doc_id)
+                bisect.insort(self._card_ids, doc_id)
+            return len(doc_ids)
+
+    def update_card(self, card_number, fields):
+        with self._lock:
+            doc_id = self._card_index.get(card_number)
+            if doc_id is None:
+                return False
+            with self._hint(self.cards, [doc_id]):
+                return len(self.cards.update(fields, doc_ids=[doc_id])) == 1
+
+    def remove_card(self, card_number):
+        with self._lock:
+            doc_id = self._card_index.pop(card_number, None)
+            if doc_id is None:
+                return False
+            self._discard_id(self._card_ids, doc_id)
+            with self._hint(self.cards, [doc_id]):
+                return len(self.cards.remove(doc_ids=[doc_id])) == 1
+
+    def remove_cards(self, card_numbers):
+        """批量删除充值卡(一次写入)，返回实际删除的card_number列表"""
+        with self._lock:
+            removed = [card_number for card_number in card_numbers if card_number in self._card_index]
+            doc_ids = [self._card_index.pop(card_number) for card_number in removed]
+            for doc_id in doc_ids:
+                self._discard_id(self._card_ids, doc_id)
+            if doc_ids:
+                with self._hint(self.cards, doc_ids):
+                    self.cards.remove(doc_ids=doc_ids)
+            return removed
+
+    def all_cards(self):
+        return self.cards.all()
+
+    def iter_cards(self):
+        return iter(self.cards)
+
+    def page_cards(self, limit, before=None, after=None):
+        return self._page(self.cards, self._card_ids, limit, before, after)
+
+    def count_cards(self):
+        return len(self._card_ids)
+
+    # 应用分类
+    def list_app_categories(self):
+        return [item['name'] for item in self.app_categories.all()]
+
+    def add_app_category(self, name):
+        with self._lock:
+            if self.app_categories.contains(Query().name == name):
+                return False
+            self.app_categories.insert({'name': name})
+            return True
+
+    def remove_app_category(self, name):
+        with self._lock:
+            return len(self.app_categories.remove(Query().name == name)) > 0
+
+    # AES配置
+    def find_aes_config(self, config_id):
+        return self.aes_configs.get(Query().config_id == config_id)
+
+    def all_aes_configs(self):
+        return self.aes_configs.all()
+
+    def insert_aes_config(self, config):
+        with self._lock:
+            return self.aes_configs.insert(config) > 0
+
+    def remove_aes_config(self, config_id):
+        with self._lock:
+            return len(self.aes_configs.remove(Query().config_id == config_id)) > 0
+
+    def apply_changes(self, table, docs):
+        """
+        在只读副本上应用写进程广播的一批变更，docs: {key: doc}，doc为None表示记录已删除
+        用户表和充值卡表按删除、修改、新增各一次写入，不逐条写入(每次写入都要复制整张表)
+        """
+        with self._lock:
+            if table == 'user':
+                self._apply_docs(self.users, self._user_index, 'machine_code', docs, self.remove_users, self.insert_users)
+            elif table == 'card':
+                self._apply_docs(self.cards, self._card_index, 'card_number', docs, self.remove_cards, self.insert_cards)
+            elif table == 'app_categories':
+                for key, doc in docs.items():
+                    if doc is None:
+                        self.remove_app_category(key)
+                    else:
+                        self.add_app_category(key)
+            elif table == 'aes_configs':
+                for key, doc in docs.items():
+                    self.remove_aes_config(key)
+                    if doc is not None:
+                        self.insert_aes_config(doc)
+
+    @staticmethod
+    def _apply_docs(table, index, key_name, docs, remove, insert):
+        removed = [key for key, doc in docs.items() if doc is None]
+        if removed:
+            remove(removed)
+        updated = {key: doc for key, doc in docs.items() if doc is not None and key in index}
+        if updated:
+            table.update(lambda doc: doc.update(updated[doc[key_name]]), doc_ids=[index[key] for key in updated])
+        inserted = [doc for key, doc in docs.items() if doc is not None and key not in index]
+        if inserted:
+            insert(inserted)
+
+    def file_size(self):
+        """数据库文件(含WAL日志)占用的字节数"""
+        return _file_size(self.path, self.path + '.wal', self.path + '.wal.old')
+
+    def close(self):
+        self.db.close()
+
+
+# SQLite数据后端
+class SQLiteBackend(object):
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            machine_code TEXT NOT NULL UNIQUE,
+            expire_date INTEGER NOT NULL,
+            reg_date INTEGER NOT NULL DEFAULT 0,
+            app_category TEXT NOT NULL DEFAULT '',
+            remark TEXT NOT NULL DEFAULT '',
+            aes_config_id TEXT NOT NULL DEFAULT 'default'
+        );
+        CREATE INDEX IF NOT EXISTS idx_users_app_category ON users (app_category);
+        CREATE INDEX IF NOT EXISTS idx_users_aes_config_id ON users (aes_config_id);
+        CREATE TABLE IF NOT EXISTS cards (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            card_number TEXT NOT NULL,
+            card_pass TEXT NOT NULL,
+            days INTEGER NOT NULL,
+            used INTEGER NOT NULL DEFAULT 0,
+            used_machine_code TEXT NOT NULL DEFAULT '',
+            used_time INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_cards_card_number ON cards (card_number);
+        CREATE TABLE IF NOT EXISTS app_categories (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS row_counts (
+            name TEXT PRIMARY KEY,
+            n INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO row_counts SELECT 'users', COUNT(*) FROM users;
+        INSERT OR IGNORE INTO row_counts SELECT 'cards', COUNT(*) FROM cards;
+        CREATE TRIGGER IF NOT EXISTS users_count_insert AFTER INSERT ON users
+            BEGIN UPDATE row_counts SET n = n + 1 WHERE name = 'users'; END;
+        CREATE TRIGGER IF NOT EXISTS users_count_delete AFTER DELETE ON users
+            BEGIN UPDATE row_counts SET n = n - 1 WHERE name = 'users'; END;
+        CREATE TRIGGER IF NOT EXISTS cards_count_insert AFTER INSERT ON cards
+            BEGIN UPDATE row_counts SET n = n + 1 WHERE name = 'cards'; END;
+        CREATE TRIGGER IF NOT EXISTS cards_count_delete AFTER DELETE ON cards
+            BEGIN UPDATE row_counts SET n = n - 1 WHERE name = 'cards'; END;
+        CREATE TABLE IF NOT EXISTS aes_configs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            config_id TEXT NOT NULL UNIQUE,
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            iv TEXT NOT NULL,
+            created_time TEXT NOT NULL DEFAULT '',
+            is_default INTEGER NOT NULL DEFAULT 0
+        );
+    """
+    USER_FIELDS = ('machine_code', 'expire_date', 'reg_date', 'app_category', 'remark', 'aes_config_id')
+    CARD_FIELDS = ('card_number', 'card_pass', 'days', 'used', 'used_machine_code', 'used_time')
+    AES_CONFIG_FIELDS = ('config_id', 'name', 'key', 'iv', 'created_time', 'is_default')
+
+    def __init__(self, path):
+        """
+        基于SQLite的数据后端，WAL日志模式，多条写入通过transaction()放在同一事务中
+        写操作共用一个连接并加锁串行执行，读操作使用线程独立的连接，不会被进行中的写事务阻塞
+        path: 数据库文件路径
+        """
+        self.path = path
+        # isolation_level=None为自动提交模式，事务由transaction()显式开启
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.create_function('epoch', 1, parse_time, deterministic=True)
+        self.conn.executescript(self.SCHEMA)
+        self._migrate_epoch()
+        self._lock = threading.RLock()
+        self._depth = 0
+        # 持有写事务的线程
+        self._owner = None
+        self._local = threading.local()
+        self._readers = []
+
+    def _migrate_epoch(self):
+        """旧版本的时间字段为TEXT类型，重建用户表和充值卡表为INTEGER类型并把时间字符串转换为时间戳"""
+        columns = {row['name']: row['type'] for row in self.conn.execute('PRAGMA table_info(users)')}
+        if columns.get('expire_date') != 'TEXT':
+            return
+        # 改名后旧表上的索引和触发器随旧表一起删除，最后重新执行SCHEMA创建
+        self.conn.executescript(f"""
+            BEGIN;
+            ALTER TABLE users RENAME TO users_old;
+            ALTER TABLE cards RENAME TO cards_old;
+            {self.SCHEMA}
+            INSERT INTO users SELECT id, machine_code, epoch(expire_date), epoch(reg_date), app_category, remark, aes_config_id FROM users_old;
+            INSERT INTO cards SELECT id, card_number, card_pass, days, used, used_machine_code, epoch(used_time) FROM cards_old;
+            DROP TABLE users_old;
+            DROP TABLE cards_old;
+            {self.SCHEMA}
+            COMMIT;
+        """)
+
+    @contextmanager
+    def transaction(self):
+        """块内的写入在同一事务中提交，出现异常时回滚，可嵌套"""
+        with self._lock:
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield
+                finally:
+                    self._depth -= 1
+                return
+            self.conn.execute('BEGIN IMMEDIATE')
+            self._depth = 1
+            self._owner = threading.get_ident()
+            try:
+                yield
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            else:
+                self.conn.execute('COMMIT')
+            finally:
+                self._depth = 0
+                self._owner = None
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self.conn.execute(sql, params)
+
+    def _reader(self):
+        """返回当前线程的读连接，事务内的读操作使用写连接以读到本事务的修改"""
+        if self._owner == threading.get_ident():
+            return self.conn
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+            with self._lock:
+                self._readers.append(conn)
+        return conn
+
+    def _fetchone(self, sql, params=()):
+        return self._reader().execute(sql, params).fetchone()
+
+    def _fetchall(self, sql, params=()):
+        return self._reader().execute(sql, params).fetchall()
+
+    def _iter_rows(self, table, convert, chunk_size):
+        last_id = 0
+        while True:
+            rows = self._fetchall(f'SELECT * FROM {table} WHERE id > ? ORDER BY id LIMIT ?', (last_id, chunk_size))
+            for row in rows:
+                yield convert(row)
+            if len(rows) < chunk_size:
+                return
+            last_id = rows[-1]['id']
+
+    def _page(self, table, convert, limit, before, after):
+        """按id从新到旧分页，参数和返回值同TinyDBBackend._page()"""
+        if after is not None:
+            rows = self._fetchall(f'SELECT * FROM {table} WHERE id > ? ORDER BY id LIMIT ?', (after, limit + 1))
+            if len(rows) <= limit:
+                # 更新的记录不足一页，直接返回第一页
+                return self._page(table, convert, limit, None, None)
+            rows = rows[:limit]
+            rows.reverse()
+            has_older = self._fetchone(f'SELECT 1 FROM {table} WHERE id <= ? LIMIT 1', (after,)) is not None
+            has_newer = True
+        else:
+            if before is None:
+                rows = self._fetchall(f'SELECT * FROM {table} ORDER BY id DESC LIMIT ?', (limit + 1,))
+            else:
+                rows = self._fetchall(f'SELECT * FROM {table} WHERE id < ? ORDER BY id DESC LIMIT ?', (before, limit + 1))
+            has_older = len(rows) > limit
+            rows = rows[:limit]
+            has_newer = before is not None and self._fetchone(f'SELECT 1 FROM {table} WHERE id >= ? LIMIT 1', (before,)) is not None
+        return [(row['id'], convert(row)) for row in rows], has_older, has_newer
+
+    def _set_clause(self, fields, allowed):
+        for name in fields:
+            if name not in allowed:
+                raise ValueError(f'unknown field: {name}')
+        return ', '.join(f'{name} = ?' for name in fields)
+
+    @staticmethod
+    def _user(row):
+        if row is None:
+            return None
+        return {name: row[name] for name in SQLiteBackend.USER_FIELDS}
+
+    @staticmethod
+    def _card(row):
+        if row is None:
+            return None
+        card = {name: row[name] for name in SQLiteBackend.CARD_FIELDS}
+        card['used'] = bool(card['used'])
+        return card
+
+    @staticmethod
+    def _aes_config(row):
+        if row is None:
+            return None
+        config = {name: row[name] for name in SQLiteBackend.AES_CONFIG_FIELDS}
+        config['is_default'] = bool(config['is_default'])
+        return config
+
+    # 用户(机器码)
+    def find_user(self, machine_code):
+        return self._user(self._fetchone('SELECT * FROM users WHERE machine_code = ?', (machine_code,)))
+
+    def insert_user(self, user):
+        cursor = self._execute(
+            'INSERT OR IGNORE INTO users (machine_code, expire_date, reg_date, app_category, remark, aes_config_id) VALUES (?, ?, ?, ?, ?, ?)',
+            (user['machine_code'], user['expire_date'], user.get('reg_date', 0), user.get('app_category', ''), user.get('remark', ''), user.get('aes_config_id', 'default'))
+        )
+        return cursor.rowcount == 1
+
+    def insert_users(self, users):
+        rows = [(user['machine_code'], user['expire_date'], user.get('reg_date', 0), user.get('app_category', ''), user.get('remark', ''), user.get('aes_config_id', 'default')) for user in users]
+        with self.transaction():
+            cursor = self.conn.executemany(
+                'INSERT OR IGNORE INTO users (machine_code, expire_date, reg_date, app_category, remark, aes_config_id) VALUES (?, ?, ?, ?, ?, ?)',
+                rows
+            )
+        return cursor.rowcount
+
+    def update_user(self, machine_code, fields):
+        sql = f'UPDATE users SET {self._set_clause(fields, self.USER_FIELDS)} WHERE machine_code = ?'
+        return self._execute(sql, (*fields.values(), machine_code)).rowcount == 1
+
+    def update_users_where(self, field, value, fields):
+        if field not in self.USER_FIELDS:
+            raise ValueError(f'unknown field: {field}')
+        sql = f'UPDATE users SET {self._set_clause(fields, self.USER_FIELDS)} WHERE {field} = ?'
+        with self.transaction():
+            machine_codes = [row[0] for row in self.conn.execute(f'SELECT machine_code FROM users WHERE {field} = ?', (value,))]
+            self.conn.execute(sql, (*fields.values(), value))
+        return machine_codes
+
+    def remove_user(self, machine_code):
+        return self._execute('DELETE FROM users WHERE machine_code = ?', (machine_code,)).rowcount == 1
+
+    def remove_users(self, machine_codes):
+        with self.transaction():
+            return [machine_code for machine_code in machine_codes if self.remove_user(machine_code)]
+
+    def all_users(self):
+        return [self._user(row) for row in self._fetchall('SELECT * FROM users ORDER BY id')]
+
+    def iter_users(self, chunk_size=1000):
+        """按id顺序分块读取用户，每块单独查询，可以在不同线程中继续迭代"""
+        return self._iter_rows('users', self._user, chunk_size)
+
+    def page_users(self, limit, before=None, after=None):
+        return self._page('users', self._user, limit, before, after)
+
+    def count_users(self):
+        # 记录数由触发器维护，不需要COUNT(*)扫描全表
+        return self._fetchone("SELECT n FROM row_counts WHERE name = 'users'")[0]
+
+    # 充值卡
+    def find_card(self, card_number):
+        return self._card(self._fetchone('SELECT * FROM cards WHERE card_number = ? ORDER BY id LIMIT 1', (card_number,)))
+
+    def insert_cards(self, cards):
+        rows = [(card['card_number'], card['card_pass'], card['days'], int(card.get('used', False)), card.get('used_machine_code', ''), card.get('used_time', 0)) for card in cards]
+        with self.transaction():
+            self.conn.executemany(
+                'INSERT INTO cards (card_number, card_pass, days, used, used_machine_code, used_time) VALUES (?, ?, ?, ?, ?, ?)',
+                rows
+            )
+        return len(rows)
+
+    def update_card(self, card_number, fields):
+        fields = {name: int(value) if name == 'used' else value for name, value in fields.items()}
+        sql = f'UPDATE cards SET {self._set_clause(fields, self.CARD_FIELDS)} WHERE id = (SELECT id FROM cards WHERE card_number = ? ORDER BY id LIMIT 1)'
+        return self._execute(sql, (*fields.values(), card_number)).rowcount == 1
+
+    def remove_card(self, card_number):
+        sql = 'DELETE FROM cards WHERE id = (SELECT id FROM cards WHERE card_number = ? ORDER BY id LIMIT 1)'
+        return self._execute(sql, (card_number,)).rowcount == 1
+
+    def all_cards(self):
+        return [self._card(row) for row in self._fetchall('SELECT * FROM cards ORDER BY id')]
+
+    def iter_cards(self, chunk_size=1000):
+        return self._iter_rows('cards', self._card, chunk_size)
+
+    def page_cards(self, limit, before=None, after=None):
+        return self._page('cards', self._card, limit, before, after)
+
+    def count_cards(self):
+        return self._fetchone("SELECT n FROM row_counts WHERE name = 'cards'")[0]
+
+    # 应用分类
+    def list_app_categories(self):
+        return [row['name'] for row in self._fetchall('SELECT name FROM app_categories ORDER BY id')]
+
+    def add_app_category(self, name):
+        return self._execute('INSERT OR IGNORE INTO app_categories (name) VALUES (?)', (name,)).rowcount == 1
+
+    def remove_app_category(self, name):
+        return self._execute('DELETE FROM app_categories WHERE name = ?', (name,)).rowcount > 0
+
+    # AES配置
+    def find_aes_config(self, config_id):
+        return self._aes_config(self._fetchone('SELECT * FROM aes_configs WHERE config_id = ?', (config_id,)))
+
+    def all_aes_configs(self):
+        return [self._aes_config(row) for row in self._fetchall('SELECT * FROM aes_configs ORDER BY id')]
+
+    def insert_aes_config(self, config):
+        cursor = self._execute(
+            'INSERT OR IGNORE INTO aes_configs (config_id, name, key, iv, created_time, is_default) VALUES (?, ?, ?, ?, ?, ?)',
+            (config['config_id'], config['name'], config['key'], config['iv'], config.get('created_time', ''), int(config.get('is_default', False)))
+        )
+        return cursor.rowcount == 1
+
+    def remove_aes_config(self, config_id):
+        return self._execute('DELETE FROM aes_configs WHERE config_id = ?', (config_id,)).rowcount > 0
+
+    def apply_changes(self, table, docs):
+        # 各进程直接读取同一个SQLite数据库，无需应用变更
+        pass
+
+    def file_size(self):
+        return _file_size(self.path, self.path + '-wal')
+
+    def close(self):
+        for conn in self._readers:
+            conn.close()
+        self.conn.close()
+
+
+def _file_size(*paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+
+def migrate_json_to_sqlite(json_path, sqlite_path):
+    """
+    一次性把db.json(含未合并的WAL日志)中的数据迁移到SQLite数据库
+    目标库必须为空，返回各表迁移的记录数
+    """
+    # 只读打开源数据库(ReplicaStorage只在内存中加载快照和日志)，旧格式时间字段的转换也只发生在内存中，不修改源文件
+    source = TinyDBBackend(json_path, storage='replica')
+    target = SQLiteBackend(sqlite_path)
+    try:
+        if target.count_users() or target.count_cards():
+            raise RuntimeError(f'{sqlite_path} 中已有数据，请使用空的SQLite数据库')
+        result = {'user': 0, 'card': 0, 'app_categories': 0, 'aes_configs': 0}
+        with target.transaction():
+            for user in source.all_users():
+                user = dict(user)
+                user.setdefault('reg_date', 0)
+                result['user'] += target.insert_user(user)
+            result['card'] = target.insert_cards(source.all_cards())
+            for name in source.list_app_categories():
+                result['app_categories'] += target.add_app_category(name)
+            for config in source.all_aes_configs():
+                result['aes_configs'] += target.insert_aes_config(config)
+        return result
+    finally:
+        source.close()
+        target.close()
+
+
+if __name__ == '__main__':
+    # python3 storage_model.py ./database/db.json ./database/db.sqlite3
+    if len(sys.argv) != 3:
+        print('用法: python3 storage_model.py <db.json路径> <SQLite数据库路径>')
+        sys.exit(1)
+    print(migrate_json_to_sqlite(sys.argv[1], sys.argv[2]))
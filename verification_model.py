@@ -1,42 +1,109 @@
 # -*- coding: UTF-8 -*-
 
+import asyncio
+import functools
 import math
 import time
-import random
+import secrets
 import string
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from random import Random
 
-from dotenv import find_dotenv, load_dotenv
-from tinydb import Query, TinyDB
+from aes_model import AEScryptor
+from bloom_model import KeyFilter
+from cache_model import MISSING, TTLCache
+from clock_model import clock, format_time, parse_time
+from expiry_model import ExpiryIndex
+from lease_model import RevocationList, decode_lease, encode_lease
+from metrics_model import STORAGE_SECONDS
+from settings_model import settings
+from stats_model import DashboardStats
+from storage_model import SQLiteBackend, TinyDBBackend
+
+# 卡号卡密字符集，26*9=234，随机字节>=234时丢弃，保证每个字母出现的概率相同
+CARD_CHARS = b'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+CARD_TABLE = bytes(CARD_CHARS[i % len(CARD_CHARS)] for i in range(256))
+CARD_REJECT = bytes(range(234, 256))
+# 卡号随机部分长度和卡密长度
+CARD_NUMBER_LENGTH = 5
+CARD_PASS_LENGTH = 8
 
 
 class verification(object):
 
-    def __init__(self) -> None:
+    def __init__(self, replica=False) -> None:
+        """
+        replica: 多进程模式下worker使用的只读副本，写操作由写进程完成后通过apply_changes同步
+        """
         # 确保数据库目录存在
         Path('./database').mkdir(exist_ok=True)
         Path('./log').mkdir(exist_ok=True)
-        
-        # 设置数据库文件
-        self.db_user = TinyDB('./database/db.json', indent=4)
-        self.db_user.default_table_name = 'user'
-        self.db_card = TinyDB('./database/db.json', indent=4)
-        self.db_card.default_table_name = 'card'
+        config = settings.current
+
+        # 设置数据后端(DB_BACKEND=tinydb/sqlite，tinydb时DB_STORAGE=json/wal选择存储引擎)
+        if config.db_backend == 'sqlite':
+            self.db = SQLiteBackend(config.sqlite_path)
+        else:
+            self.db = TinyDBBackend('./database/db.json', storage='replica' if replica else config.db_storage)
+        # 数据变更监听函数listener(table, keys)，用于缓存失效和多进程同步
+        self.listeners = []
+        # AES加密器缓存 config_id -> {填充模式: AEScryptor}，以及 machine_code -> config_id
+        self._cryptors = {}
+        self._user_config_ids = {}
+        self.listeners.append(self._invalidate_cryptors)
+        # 登录验证缓存 machine_code -> (到期时间戳, 格式化的到期时间)(机器码不存在时为None)
+        self._login_cache = TTLCache(config.login_cache_size, config.login_cache_ttl)
+        self.listeners.append(self._invalidate_login_cache)
+        # 到期时间索引，用于即将到期/已过期用户查询
+        self._expiry_index = ExpiryIndex()
+        self._expiry_index.build(self.db.iter_users())
+        self.listeners.append(self._update_expiry_index)
+        # 后台概览统计
+        self._stats = DashboardStats()
+        self._stats.build(self.db.iter_users(), self.db.iter_cards())
+        self.listeners.append(self._update_stats)
+        # 机器码和卡号的布隆过滤器，一定不存在的机器码和卡号不访问数据库直接返回
+        self._user_filter = KeyFilter()
+        self._card_filter = KeyFilter()
+        self.rebuild_filters(force=True)
+        self.listeners.append(self._update_filters)
+        # 授权租约撤销列表(修改到期时间或删除用户时撤销)，租约到期后还可续期一个有效期，之后的记录不再需要
+        self._revocations = RevocationList(config.lease_ttl * 2)
         
         # 设置时区
         self.tz = timezone(timedelta(hours=8))
-        # 加载env配置环境变量
-        load_dotenv(find_dotenv(str(Path.cwd().joinpath('.env'))))
-        # 初始化默认AES配置
-        self._init_default_aes_config()
+        # 初始化默认AES配置(只读副本由写进程负责)
+        if not replica:
+            self._init_default_aes_config()
+
+    def _changed(self, table, *keys):
+        """通知监听函数table表中keys对应的记录发生了变更(新增、修改或删除)"""
+        if not keys:
+            return
+        for listener in self.listeners:
+            listener(table, keys)
+
+    def apply_changes(self, changes):
+        """
+        在只读副本上应用写进程广播的变更
+        changes: [(table, key, doc), ...]，doc为None表示记录已删除
+        """
+        # 按表分组后整批应用，同一条记录只保留最后的状态
+        tables = {}
+        for table, key, doc in changes:
+            if table == 'lease_revocations':
+                self._revocations.revoke(key, doc['revoked_at'])
+                continue
+            tables.setdefault(table, {})[key] = doc
+        for table, docs in tables.items():
+            self.db.apply_changes(table, docs)
+            self._changed(table, *docs)
 
     def _init_default_aes_config(self):
         """初始化默认AES配置"""
-        aes_configs = self.db_user.table('aes_configs')
-        if not aes_configs.contains(Query().config_id == 'default'):
-            aes_configs.insert({
+        if self.db.find_aes_config('default') is None:
+            self.db.insert_aes_config({
                 'config_id': 'default',
                 'name': '默认加密',
                 'key': '更改一下自己用的，或参考源代码',
@@ -44,87 +111,290 @@ class verification(object):
                 'created_time': datetime.now(self.tz).strftime('%Y-%m-%d %H:%M:%S'),
                 'is_default': True
             })
+            self._changed('aes_configs', 'default')
 
     # 机器码注册
-    def reg(self, machine_code: str, expire_date: str, app_category='', remark=''):
-        result_search = self.db_user.get(Query().machine_code == machine_code)
-        if result_search in [None, []]:
-            result_insert = self.db_user.insert({
+    def reg(self, machine_code: str, expire_date, app_category='', remark=''):
+        """expire_date: '%Y-%m-%d %H:%M:%S'或整数时间戳"""
+        if self.db.find_user(machine_code) is None:
+            expire_date = parse_time(expire_date)
+            result_insert = self.db.insert_user({
                 'machine_code': machine_code, 
                 'expire_date': expire_date, 
-                'reg_date': datetime.now(self.tz).strftime('%Y-%m-%d %H:%M:%S'),
+                'reg_date': clock.now(),
                 'app_category': app_category,
                 'remark': remark,
                 'aes_config_id': 'default'  # 默认使用默认加密
             })
-            if result_insert > 0:
-                return {'code': 10000, 'msg': '机器码注册成功', 'expireDate': expire_date}
+            if result_insert:
+                self._changed('user', machine_code)
+                return {'code': 10000, 'msg': '机器码注册成功', 'expireDate': format_time(expire_date)}
             else:
                 return {'code': 10011, 'msg': '机器码注册失败'}
         else:
             return {'code': 10010, 'msg': '机器码已存在'}
         
-    # 机器码登录验证
-    def login(self, machine_code: str):
-        result = self.db_user.search(Query().machine_code == machine_code)
+    def _invalidate_login_cache(self, table, keys):
+        if table == 'user':
+            for key in keys:
+                self._login_cache.pop(key)
+
+    def _update_expiry_index(self, table, keys):
+        if table == 'user':
+            for key in keys:
+                user = self.db.find_user(key)
+                self._expiry_index.update(key, None if user is None else user['expire_date'])
+
+    def _update_stats(self, table, keys):
+        if table == 'user':
+            for key in keys:
+                self._stats.update_user(key, self.db.find_user(key))
+        elif table == 'card':
+            for key in keys:
+                self._stats.update_card(key, self.db.find_card(key))
+
+    def _update_filters(self, table, keys):
+        if table == 'user':
+            for key in keys:
+                if self.db.find_user(key) is None:
+                    self._user_filter.discard(key)
+                else:
+                    self._user_filter.add(key)
+        elif table == 'card':
+            for key in keys:
+                if self.db.find_card(key) is None:
+                    self._card_filter.discard(key)
+                else:
+                    self._card_filter.add(key)
+
+    # 重建布隆过滤器
+    def rebuild_filters(self, force=False):
+        """
+        启动时及定期调用，删除较多或数量超过容量的过滤器按当前数据重建
+        返回重建的过滤器名称列表
+        """
+        rebuilt = []
+        if force or self._user_filter.needs_rebuild():
+            self._user_filter.build(lambda: (user['machine_code'] for user in self.db.iter_users()), self.db.count_users())
+            rebuilt.append('user')
+        if force or self._card_filter.needs_rebuild():
+            self._card_filter.build(lambda: (card['card_number'] for card in self.db.iter_cards()), self.db.count_cards())
+            rebuilt.append('card')
+        return rebuilt
+
+    # 缓存命中统计
+    def get_cache_stats(self):
+        """返回 {缓存名: (命中次数, 未命中次数, 条目数)}"""
+        return {'login': (self._login_cache.hits, self._login_cache.misses, len(self._login_cache))}
+
+    # 后台概览统计
+    def get_stats(self):
+        return {'code': 10000, 'msg': '查询成功', 'data': self._stats.snapshot(clock.now())}
+
+    def _get_expire_date(self, machine_code):
+        """获取机器码(到期时间戳, 格式化的到期时间)(带缓存)，机器码不存在时返回None"""
+        # 布隆过滤器判断一定不存在时不查询也不缓存，避免随机机器码占满缓存
+        if machine_code not in self._user_filter:
+            return None
+        # 缓存的是到期时间而不是验证结果，是否过期每次按当前时间判断
+        expire_date = self._login_cache.get(machine_code)
+        if expire_date is MISSING:
+            version = self._login_cache.version
+            result = self.db.find_user(machine_code)
+            expire_date = None if result is None else (result['expire_date'], format_time(result['expire_date']))
+            self._login_cache.set(machine_code, expire_date, version)
+        return expire_date
+
+    @staticmethod
+    def _login_result(expire_date, now):
         # 判断机器码是否存在数据库中
-        if result not in [None, []]:
-            # 判断该机器码是否过期
-            if result[0]['expire_date'] > datetime.now(self.tz).strftime('%Y-%m-%d %H:%M:%S'):
-                return {'code': 10000, 'msg': '机器码未过期', 'expireDate': result[0]['expire_date'], 'nowtime': int(time.time())}
+        if expire_date is not None:
+            # 判断该机器码是否过期(整数时间戳比较)
+            if expire_date[0] > now:
+                return {'code': 10000, 'msg': '机器码未过期', 'expireDate': expire_date[1]}
             else:
-                return {'code': 10011, 'msg': '机器码已过期', 'expireDate': result[0]['expire_date'], 'nowtime': int(time.time())}
+                return {'code': 10011, 'msg': '机器码已过期', 'expireDate': expire_date[1]}
         else:
-            return {'code': 10010, 'msg': '机器码不存在', 'nowtime': int(time.time())}
+            return {'code': 10010, 'msg': '机器码不存在'}
+
+    # 机器码登录验证
+    def login(self, machine_code: str):
+        now = clock.now()
+        expire_date = self._get_expire_date(machine_code)
+        result = self._login_result(expire_date, now)
+        result['nowtime'] = now
+        if result['code'] == 10000 and settings.current.lease_private_key:
+            result['lease'] = encode_lease(settings.current.lease_private_key, machine_code, expire_date[0], now, settings.current.lease_ttl)
+        return result
+
+    # 授权租约续期
+    def refresh_lease(self, lease: str):
+        """
+        校验租约签名和撤销列表，授权到期时间按机器码重新读取(通常命中登录验证缓存)，不信任租约中的到期时间
+        租约到期后的一个有效期内可以续期
+        """
+        config = settings.current
+        if not config.lease_private_key:
+            return {'code': 10080, 'msg': '未开启授权租约'}
+        payload = decode_lease(config.lease_private_key, lease)
+        if payload is None:
+            return {'code': 10081, 'msg': '非法的租约'}
+        now = clock.now()
+        # 签发时间晚于当前时间或有效期超过lease_ttl的租约不是本服务签发的(私钥泄露或时钟回拨)，签发时间也不能用来绕过撤销列表
+        if payload['i'] > now or payload['x'] > payload['i'] + config.lease_ttl:
+            return {'code': 10081, 'msg': '非法的租约'}
+        if payload['x'] + config.lease_ttl < now:
+            return {'code': 10082, 'msg': '租约已过期，请重新验证'}
+        if self._revocations.is_revoked(payload['m'], payload['i']):
+            return {'code': 10083, 'msg': '租约已撤销，请重新验证'}
+        # 充值、导入等修改到期时间后续期得到的是新的到期时间
+        expire_date = self._get_expire_date(payload['m'])
+        if expire_date is None:
+            return {'code': 10010, 'msg': '机器码不存在'}
+        if expire_date[0] <= now:
+            return {'code': 10011, 'msg': '机器码已过期', 'expireDate': expire_date[1]}
+        return {
+            'code': 10000, 'msg': '租约已续期', 'expireDate': expire_date[1], 'nowtime': now,
+            'lease': encode_lease(config.lease_private_key, payload['m'], expire_date[0], now, config.lease_ttl),
+        }
+
+    # 授权租约撤销列表
+    def get_lease_revocations(self, since=0):
+        """since之后的撤销记录[[机器码摘要, 撤销时间戳], ...]"""
+        now = clock.now()
+        return {'code': 10000, 'msg': '查询成功', 'data': self._revocations.since(since, now), 'nowtime': now}
+
+    def get_lease_revocation(self, machine_code: str):
+        """写进程广播撤销记录时使用，没有记录时返回None"""
+        revoked_at = self._revocations.get(machine_code)
+        return None if revoked_at is None else {'revoked_at': revoked_at}
+
+    def _revoke_lease(self, machine_code):
+        self._revocations.revoke(machine_code, clock.now())
+        self._changed('lease_revocations', machine_code)
+
+    # 批量机器码登录验证
+    def login_batch(self, machine_codes):
+        """逐个查询machine_codes，返回 {machine_code: 验证结果}，当前时间只取一次"""
+        now = clock.now()
+        return {machine_code: self._login_result(self._get_expire_date(machine_code), now) for machine_code in machine_codes}
 
     # 获取用户的AES配置
     def get_user_aes_config(self, machine_code: str):
-        user = self.db_user.get(Query().machine_code == machine_code)
+        user = self.db.find_user(machine_code)
         if user and 'aes_config_id' in user:
-            aes_configs = self.db_user.table('aes_configs')
-            config = aes_configs.get(Query().config_id == user['aes_config_id'])
+            config = self.db.find_aes_config(user['aes_config_id'])
             if config:
                 return {'key': config['key'], 'iv': config['iv']}
         # 返回默认配置
-        aes_configs = self.db_user.table('aes_configs')
-        default_config = aes_configs.get(Query().config_id == 'default')
+        default_config = self.db.find_aes_config('default')
         if default_config:
             return {'key': default_config['key'], 'iv': default_config['iv']}
         return None
 
+    def _invalidate_cryptors(self, table, keys):
+        if table == 'user':
+            for key in keys:
+                self._user_config_ids.pop(key, None)
+        elif table == 'aes_configs':
+            for key in keys:
+                self._cryptors.pop(key, None)
+
+    # 只查缓存的加密器，不访问数据库，可在事件循环中直接调用
+    def cached_user_cryptor(self, machine_code: str, padding_mode='ZeroPadding'):
+        """缓存未命中时返回None，由调用方改用get_user_cryptor"""
+        config_id = self._user_config_ids.get(machine_code)
+        if config_id is None:
+            if machine_code in self._user_filter:
+                return None
+            config_id = 'default'
+        return self.cached_cryptor(config_id, padding_mode)
+
+    def cached_cryptor(self, config_id='default', padding_mode='ZeroPadding'):
+        cryptors = self._cryptors.get(config_id)
+        return cryptors.get(padding_mode) if cryptors else None
+
+    # 获取用户的AES加密器(带缓存)
+    def get_user_cryptor(self, machine_code: str, padding_mode='ZeroPadding'):
+        """
+        返回用户所用AES配置对应的加密器，缓存命中时不访问数据库
+        用户不存在时使用默认配置，默认配置也不存在时返回None
+        """
+        config_id = self._user_config_ids.get(machine_code)
+        if config_id is None:
+            user = self.db.find_user(machine_code) if machine_code in self._user_filter else None
+            if user is None:
+                # 不缓存不存在的机器码，避免缓存被随机机器码撑大
+                config_id = 'default'
+            else:
+                config_id = user.get('aes_config_id') or 'default'
+                self._user_config_ids[machine_code] = config_id
+        return self.get_cryptor(config_id, padding_mode)
+
+    # 获取AES配置对应的加密器(带缓存)
+    def get_cryptor(self, config_id='default', padding_mode='ZeroPadding'):
+        """
+        配置不存在时使用默认配置，默认配置也不存在时返回None
+        padding_mode: 填充模式，旧版返回格式使用ZeroPadding，v2格式使用PKCS7Padding
+        """
+        cryptors = self._cryptors.get(config_id)
+        cryptor = cryptors.get(padding_mode) if cryptors else None
+        if cryptor is None:
+            config = self.db.find_aes_config(config_id) or self.db.find_aes_config('default')
+            if config is None:
+                return None
+            cryptor = AEScryptor(key=config['key'], iv=config['iv'], paddingMode=padding_mode, characterSet='utf-8')
+            self._cryptors.setdefault(config_id, {})[padding_mode] = cryptor
+        return cryptor
+
     # 机器码充值
     def recharge(self, machine_code: str, card_number: str, card_pass: str):
+        result = self.recharge_precheck(machine_code, card_number)
+        if result is not None:
+            return result
+        # 查询与修改放在同一事务中，避免同一张充值卡被并发重复使用
+        with self.db.transaction():
+            return self._recharge(machine_code, card_number, card_pass)
+
+    def recharge_precheck(self, machine_code: str, card_number: str):
+        """布隆过滤器判断机器码或充值卡一定不存在时返回充值结果，否则返回None，不访问数据库"""
+        if machine_code not in self._user_filter:
+            return {'code': 10030, 'msg': '机器码不存在'}
+        if card_number not in self._card_filter:
+            return {'code': 10031, 'msg': '充值卡不存在'}
+        return None
+
+    def _recharge(self, machine_code: str, card_number: str, card_pass: str):
         # 查询机器码是否存在
-        result_user = self.db_user.get(Query().machine_code == machine_code)
-        if result_user in [None, []]:
+        result_user = self.db.find_user(machine_code)
+        if result_user is None:
             return {'code': 10030, 'msg': '机器码不存在'}
         # 查询充值卡信息
-        result_card = self.db_card.get(Query().card_number == card_number and Query().card_pass == card_pass)
-        if result_card not in [None, []]:
+        result_card = self.db.find_card(card_number)
+        if result_card is not None and result_card.get('card_pass') == card_pass:
             if not result_card.get('used'):
                 user_expire_date = result_user.get('expire_date')
                 card_days = result_card.get('days')
-                # 判断机器码授权日期是否过期
-                if user_expire_date >= datetime.now(self.tz).strftime('%Y-%m-%d %H:%M:%S'):
-                    new_date_time = datetime.strptime(user_expire_date, '%Y-%m-%d %H:%M:%S') + timedelta(days=card_days)
-                    new_date_time = new_date_time.strftime('%Y-%m-%d %H:%M:%S')
-                else:
-                    new_date_time = datetime.now(self.tz) + timedelta(days=card_days)
-                    new_date_time = new_date_time.strftime('%Y-%m-%d %H:%M:%S')
+                now = clock.now()
+                # 未过期时在原到期时间上增加天数，已过期时从现在开始计算
+                new_date_time = max(user_expire_date, now) + card_days * 86400
                 # 修改机器码授权日期
-                result_user_update = self.db_user.update({'expire_date': new_date_time}, Query().machine_code == machine_code)
-                if len(result_user_update) == 1:
+                result_user_update = self.db.update_user(machine_code, {'expire_date': new_date_time})
+                if result_user_update:
+                    self._changed('user', machine_code)
                     # 修改充值卡使用状态
-                    result_card_update = self.db_card.update({
+                    result_card_update = self.db.update_card(card_number, {
                             'used': True,
                             'used_machine_code': result_user.get('machine_code'),
-                            'used_time': datetime.now(self.tz).strftime('%Y-%m-%d %H:%M:%S')
-                        }, Query().card_number == card_number and Query().card_pass == card_pass)
-                    if len(result_card_update) != 1:
+                            'used_time': now
+                        })
+                    if result_card_update:
+                        self._changed('card', card_number)
+                    else:
                         # 追加写入日志文件
                         with open('./log/error.log', 'a') as f:
                             f.write(self.get_server_time() + '\t充值卡使用状态修改失败\t' + machine_code + '\t' + card_number + '\t' + card_pass + '\r\n')
-                    return {'code': 10000, 'msg': '充值成功', 'expireDate': new_date_time}
+                    return {'code': 10000, 'msg': '充值成功', 'expireDate': format_time(new_date_time)}
                 else:
                     return {'code': 10033, 'msg': '充值失败，请于管理员联系。'}
             else:
@@ -134,163 +404,208 @@ class verification(object):
 
     # 充值卡生成
     def make_new_card(self, number: int, days: int):
-        # 批量生成充值卡
-        insert_result = self.db_card.insert_multiple({'card_number': self.new_card_number(), 'card_pass': self.random_str(8), 'days': days, 'used': False, 'used_machine_code': '', 'used_time': ''} for i in range(number))
-        if insert_result not in [None, []]:
+        new_cards = self.generate_cards(number, days)
+        if new_cards:
             print_result = []
-            for i in insert_result:
-                get_data = self.db_card.get(doc_id=i)
-                print_result.append([get_data["card_number"], get_data["card_pass"], get_data["days"]])
+            for card in new_cards:
+                print_result.append([card["card_number"], card["card_pass"], card["days"]])
             return {'code': 10000, 'msg': '充值卡生成成功', 'data': print_result}
         else:
             return {'code': 10020, 'msg': '充值卡生成失败'}
 
-    # 获取充值卡列表(分页)
-    def get_card(self, page: int, limit: int):
+    # 批量生成充值卡
+    def generate_cards(self, number: int, days: int):
+        """
+        卡号为当天日期+5位随机字母，卡密为8位随机字母，随机数来自系统CSPRNG
+        卡号通过索引检查与已有卡号及本批次卡号均不重复，整批一次写入
+        返回生成的充值卡列表，卡号空间不足导致无法生成时返回None
+        """
+        record_length = CARD_NUMBER_LENGTH + CARD_PASS_LENGTH
+        with self.db.transaction():
+            date = time.strftime('%Y%m%d', time.localtime(time.time()))
+            new_cards = []
+            new_numbers = set()
+            # 重复的卡号会被丢弃重新生成，超过该次数说明当天的卡号已接近用尽
+            attempts = number * 10 + 1000
+            while len(new_cards) < number:
+                need = min(number - len(new_cards), attempts)
+                if need <= 0:
+                    return None
+                attempts -= need
+                # 一次取出本轮所需的全部随机字母
+                letters = self.random_str(need * record_length)
+                for i in range(0, len(letters), record_length):
+                    card_number = date + letters[i:i + CARD_NUMBER_LENGTH]
+                    if card_number in new_numbers or self.db.find_card(card_number) is not None:
+                        continue
+                    new_numbers.add(card_number)
+                    new_cards.append({'card_number': card_number, 'card_pass': letters[i + CARD_NUMBER_LENGTH:i + record_length], 'days': days, 'used': False, 'used_machine_code': '', 'used_time': 0})
+            if not self.db.insert_cards(new_cards):
+                return None
+        self._changed('card', *new_numbers)
+        return new_cards
+
+    # 批量导入用户
+    def import_users(self, users):
+        """
+        users: 已校验的用户列表，跳过数据库中已存在的机器码，整批一次写入
+        返回 {'imported': 导入数量, 'duplicates': 跳过数量}
+        """
+        new_users = [
+            dict(user, expire_date=parse_time(user['expire_date']), reg_date=parse_time(user['reg_date']))
+            for user in users if self.db.find_user(user['machine_code']) is None
+        ]
+        imported = self.db.insert_users(new_users) if new_users else 0
+        self._changed('user', *[user['machine_code'] for user in new_users])
+        return {'imported': imported, 'duplicates': len(users) - imported}
+
+    # 批量导入充值卡
+    def import_cards(self, cards):
+        """
+        cards: 已校验的充值卡列表，跳过数据库中已存在的卡号，整批一次写入
+        返回 {'imported': 导入数量, 'duplicates': 跳过数量}
+        """
+        new_cards = [
+            dict(card, used_time=parse_time(card.get('used_time', '')))
+            for card in cards if self.db.find_card(card['card_number']) is None
+        ]
+        imported = self.db.insert_cards(new_cards) if new_cards else 0
+        self._changed('card', *[card['card_number'] for card in new_cards])
+        return {'imported': imported, 'duplicates': len(cards) - imported}
+
+    # 导出用户
+    def export_users(self, app_category=None, expire_from=None, expire_to=None):
+        """
+        返回按条件过滤的用户迭代器，逐条读取，不复制整张表
+        app_category: 应用分类，None为不过滤
+        expire_from/expire_to: 到期时间范围(含两端)，'%Y-%m-%d %H:%M:%S'或'%Y-%m-%d'，None为不限
+        返回的时间字段已格式化为字符串
+        """
+        expire_from = None if expire_from is None else parse_time(expire_from)
+        expire_to = None if expire_to is None else parse_time(expire_to)
+        for user in self.db.iter_users():
+            if app_category is not None and user.get('app_category', '') != app_category:
+                continue
+            if expire_from is not None and user['expire_date'] < expire_from:
+                continue
+            if expire_to is not None and user['expire_date'] > expire_to:
+                continue
+            yield dict(user, expire_date=format_time(user['expire_date']), reg_date=format_time(user.get('reg_date')))
+
+    # 导出充值卡
+    def export_cards(self, used=None):
+        """
+        返回按条件过滤的充值卡迭代器，逐条读取，不复制整张表
+        used: True只导出已使用，False只导出未使用，None为不过滤
+        """
+        for card in self.db.iter_cards():
+            if used is not None and bool(card['used']) != used:
+                continue
+            yield dict(card, used_time=format_time(card.get('used_time')))
+
+    # 分页结果
+    @staticmethod
+    def _page_result(rows, has_older, has_newer, count_data, limit, to_list, code):
+        """
+        rows: 后端page_*()返回的[(id, 记录), ...]
+        first_id/last_id为本页第一条和最后一条的id，作为上一页(after=first_id)和下一页(before=last_id)的游标
+        """
+        return {
+            'code': 10000 if rows else code,
+            'msg': '查询成功' if rows else '查询失败或无数据',
+            'count_data': count_data,
+            'all_page': math.ceil(count_data / limit) if count_data else 1,
+            'first_id': rows[0][0] if rows else None,
+            'last_id': rows[-1][0] if rows else None,
+            'has_prev': has_newer,
+            'has_next': has_older,
+            'data': [to_list(doc) for _, doc in rows]
+        }
+
+    # 获取充值卡列表(按游标分页，从新到旧)
+    def get_card(self, limit: int, before: int = None, after: int = None):
+        """
+        limit: 每页条数
+        before: 下一页游标，取id小于before的记录
+        after: 上一页游标，取id大于after的记录，after=0为最后一页
+        都不传时为第一页，只读取本页的记录
+        """
         try:
-            # 查询充值卡列表
-            result_card = self.db_card.all()
-            # 逆序排列
-            result_card.reverse()
-            # 总条数
-            count_data = len(result_card)
-            # 向上取整得到总页数
-            all_page = math.ceil(len(result_card) / limit) if result_card else 1
-            
-            if result_card:  # 简化判断条件
-                result_card = result_card[(page - 1) * limit:page * limit]
-                result_card_list = []
-                for i in result_card:
-                    result_card_list.append([
-                        i.get("card_number", ""), 
-                        i.get("card_pass", ""), 
-                        i.get("days", 0), 
-                        str(i.get("used", False)), 
-                        i.get("used_machine_code", ""), 
-                        i.get("used_time", "")
-                    ])
-                return {
-                    'code': 10000, 
-                    'msg': '查询成功', 
-                    'count_data': count_data, 
-                    'page': page, 
-                    'all_page': all_page, 
-                    'data': result_card_list
-                }
-            else:
-                # 即使没有数据也要返回完整结构
-                return {
-                    'code': 10021, 
-                    'msg': '查询失败或无数据', 
-                    'count_data': 0, 
-                    'page': page, 
-                    'all_page': 1, 
-                    'data': []
-                }
+            rows, has_older, has_newer = self.db.page_cards(limit, before, after)
+            return self._page_result(rows, has_older, has_newer, self.db.count_cards(), limit, lambda i: [
+                i.get("card_number", ""),
+                i.get("card_pass", ""),
+                i.get("days", 0),
+                str(i.get("used", False)),
+                i.get("used_machine_code", ""),
+                format_time(i.get("used_time"))
+            ], 10021)
         except Exception as e:
             print(f"get_card error: {e}")
             # 确保返回完整结构
-            return {
-                'code': 10021, 
-                'msg': f'查询失败: {str(e)}', 
-                'count_data': 0, 
-                'page': page, 
-                'all_page': 1, 
-                'data': []
-            }
+            return self._page_result([], False, False, 0, limit, None, 10021)
 
     # 删除充值卡
     def delete_card(self, card_number: str):
-        result_card = self.db_card.remove(Query().card_number == card_number)
-        if len(result_card) == 1:
+        result_card = self.db.remove_card(card_number)
+        if result_card:
+            self._changed('card', card_number)
             return {'code': 10000, 'msg': '充值卡删除成功'}
         else:
             return {'code': 10022, 'msg': '充值卡删除失败'}
 
     # 充值卡查询
     def search_card(self, card_number: str):
-        result_card = self.db_card.get(Query().card_number == card_number)
-        if result_card not in [None, []]:
-            return {'code': 10000, 'msg': '查询成功', 'data': [result_card["card_number"], result_card["card_pass"], result_card["days"], str(result_card["used"]), result_card["used_machine_code"], result_card["used_time"]]}
+        result_card = self.db.find_card(card_number)
+        if result_card is not None:
+            return {'code': 10000, 'msg': '查询成功', 'data': [result_card["card_number"], result_card["card_pass"], result_card["days"], str(result_card["used"]), result_card["used_machine_code"], format_time(result_card["used_time"])]}
         else:
             return {'code': 10023, 'msg': '该充值卡不存在'}
 
-    # 获取用户(机器码)列表(分页)
-    def get_user(self, page: int, limit: int):
+    # 获取用户(机器码)列表(按游标分页，从新到旧)，参数同get_card
+    def get_user(self, limit: int, before: int = None, after: int = None):
         try:
-            # 查询用户列表
-            result_user = self.db_user.all()
-            # 逆序排列
-            result_user.reverse()
-            # 总条数
-            count_data = len(result_user)
-            # 向上取整得到总页数
-            all_page = math.ceil(len(result_user) / limit) if result_user else 1
-            
-            if result_user:
-                result_user = result_user[(page - 1) * limit:page * limit]
-                result_user_list = []
-                for i in result_user:
-                    result_user_list.append([
-                        i.get("machine_code", ""), 
-                        i.get("expire_date", ""), 
-                        i.get("reg_date", ""),
-                        i.get("app_category", ""),
-                        i.get("remark", ""),
-                        i.get("aes_config_id", "default")
-                    ])
-                return {
-                    'code': 10000, 
-                    'msg': '查询成功', 
-                    'count_data': count_data, 
-                    'page': page, 
-                    'all_page': all_page, 
-                    'data': result_user_list
-                }
-            else:
-                return {
-                    'code': 10022, 
-                    'msg': '查询失败或无数据', 
-                    'count_data': 0, 
-                    'page': page, 
-                    'all_page': 1, 
-                    'data': []
-                }
+            rows, has_older, has_newer = self.db.page_users(limit, before, after)
+            return self._page_result(rows, has_older, has_newer, self.db.count_users(), limit, lambda i: [
+                i.get("machine_code", ""),
+                format_time(i.get("expire_date")),
+                format_time(i.get("reg_date")),
+                i.get("app_category", ""),
+                i.get("remark", ""),
+                i.get("aes_config_id", "default")
+            ], 10022)
         except Exception as e:
             print(f"get_user error: {e}")
-            return {
-                'code': 10022, 
-                'msg': f'查询失败: {str(e)}', 
-                'count_data': 0, 
-                'page': page, 
-                'all_page': 1, 
-                'data': []
-            }
+            return self._page_result([], False, False, 0, limit, None, 10022)
 
     # 修改用户(机器码)过期时间
-    def update_user(self, machine_code: str, expire_date: str):
-        result_user = self.db_user.update({'expire_date': expire_date}, Query().machine_code == machine_code)
-        if len(result_user) == 1:
+    def update_user(self, machine_code: str, expire_date):
+        result_user = self.db.update_user(machine_code, {'expire_date': parse_time(expire_date)})
+        if result_user:
+            self._changed('user', machine_code)
+            self._revoke_lease(machine_code)
             return {'code': 10000, 'msg': '修改成功'}
         else:
             return {'code': 10024, 'msg': '机器码过期时间修改失败'}
 
     # 删除用户(机器码)
     def delete_user(self, machine_code: str):
-        result_user = self.db_user.remove(Query().machine_code == machine_code)
-        if len(result_user) == 1:
+        result_user = self.db.remove_user(machine_code)
+        if result_user:
+            self._changed('user', machine_code)
+            self._revoke_lease(machine_code)
             return {'code': 10000, 'msg': '用户删除成功'}
         else:
             return {'code': 10025, 'msg': '用户删除失败'}
 
     # 用户(机器码)查询
     def search_user(self, machine_code: str):
-        result_user = self.db_user.get(Query().machine_code == machine_code)
-        if result_user not in [None, []]:
+        result_user = self.db.find_user(machine_code)
+        if result_user is not None:
             return {'code': 10000, 'msg': '查询成功', 'data': [
                 result_user["machine_code"], 
-                result_user["expire_date"], 
-                result_user["reg_date"],
+                format_time(result_user["expire_date"]),
+                format_time(result_user.get("reg_date")),
                 result_user.get("app_category", ""),
                 result_user.get("remark", ""),
                 result_user.get("aes_config_id", "default")
@@ -298,51 +613,95 @@ class verification(object):
         else:
             return {'code': 10026, 'msg': '该用户不存在'}
 
+    # 即将到期的用户
+    def get_expiring_users(self, days: int, limit=1000):
+        """返回未来days天内到期的用户[[机器码, 到期时间], ...]，按到期时间升序，最多limit条"""
+        now = clock.now()
+        return self._expiry_result(now, now + days * 86400, limit)
+
+    # 已过期的用户
+    def get_expired_users(self, since=None, limit=1000):
+        """返回从since(为None时不限)到现在已过期的用户，格式同get_expiring_users"""
+        return self._expiry_result(None if since is None else parse_time(since), clock.now(), limit)
+
+    def _expiry_result(self, start, end, limit):
+        entries = self._expiry_index.range(start, end, limit)
+        return {
+            'code': 10000,
+            'msg': '查询成功',
+            'count_data': self._expiry_index.count(start, end),
+            'data': [[machine_code, format_time(expire_date)] for expire_date, machine_code in entries]
+        }
+
+    # 按到期时间分段统计用户数量
+    def get_expiry_buckets(self):
+        now = clock.now()
+        bounds = [None] + [now + days * 86400 for days in (0, 1, 7, 30)] + [None]
+        names = ['expired', 'in_1_day', 'in_7_days', 'in_30_days', 'later']
+        return {
+            'code': 10000,
+            'msg': '查询成功',
+            'data': {name: self._expiry_index.count(bounds[i], bounds[i + 1]) for i, name in enumerate(names)}
+        }
+
+    # 清理过期用户
+    def sweep_expired_users(self, before):
+        """删除到期时间早于before的用户，返回删除数量"""
+        before = parse_time(before)
+        if before > clock.now():
+            return {'code': 10027, 'msg': '只能清理已过期的用户'}
+        with self.db.transaction():
+            machine_codes = [machine_code for _, machine_code in self._expiry_index.range(None, before)]
+            removed = self.db.remove_users(machine_codes)
+        self._changed('user', *removed)
+        return {'code': 10000, 'msg': '清理成功', 'count_data': len(removed)}
+
     # 获取所有应用分类
     def get_app_categories(self):
-        app_categories = self.db_user.table('app_categories')
-        return [item['name'] for item in app_categories.all()]
+        return self.db.list_app_categories()
 
     def add_app_category(self, category_name):
-        app_categories = self.db_user.table('app_categories')
         # 检查是否已存在
-        if not app_categories.contains(Query().name == category_name):
-            app_categories.insert({'name': category_name})
+        if self.db.add_app_category(category_name):
+            self._changed('app_categories', category_name)
             return {'code': 10000, 'msg': '应用分类添加成功'}
         return {'code': 10040, 'msg': '应用分类已存在'}
 
     def delete_app_category(self, category_name):
-        app_categories = self.db_user.table('app_categories')
         # 先检查应用分类是否存在
-        if not app_categories.contains(Query().name == category_name):
+        if category_name not in self.db.list_app_categories():
             return {'code': 10041, 'msg': '应用分类不存在'}
         
-        # 删除应用分类前，先将使用该分类的用户的应用分类清空
-        self.db_user.update({'app_category': ''}, Query().app_category == category_name)
-        
-        # 然后删除应用分类
-        result = app_categories.remove(Query().name == category_name)
-        if len(result) > 0:
+        with self.db.transaction():
+            # 删除应用分类前，先将使用该分类的用户的应用分类清空
+            machine_codes = self.db.update_users_where('app_category', category_name, {'app_category': ''})
+            
+            # 然后删除应用分类
+            result = self.db.remove_app_category(category_name)
+        self._changed('user', *machine_codes)
+        if result:
+            self._changed('app_categories', category_name)
             return {'code': 10000, 'msg': '应用分类删除成功'}
         return {'code': 10041, 'msg': '应用分类删除失败'}
 
     def update_user_app(self, machine_code, app_name):
-        result = self.db_user.update({'app_category': app_name}, Query().machine_code == machine_code)
-        if len(result) == 1:
+        result = self.db.update_user(machine_code, {'app_category': app_name})
+        if result:
+            self._changed('user', machine_code)
             return {'code': 10000, 'msg': '应用分类更新成功'}
         return {'code': 10042, 'msg': '应用分类更新失败'}
 
     def update_user_remark(self, machine_code, remark):
-        result = self.db_user.update({'remark': remark}, Query().machine_code == machine_code)
-        if len(result) == 1:
+        result = self.db.update_user(machine_code, {'remark': remark})
+        if result:
+            self._changed('user', machine_code)
             return {'code': 10000, 'msg': '备注更新成功'}
         return {'code': 10043, 'msg': '备注更新失败'}
 
     # AES配置管理
     def get_aes_configs(self):
-        aes_configs = self.db_user.table('aes_configs')
         configs = []
-        for config in aes_configs.all():
+        for config in self.db.all_aes_configs():
             configs.append({
                 'config_id': config['config_id'],
                 'name': config['name'],
@@ -353,14 +712,13 @@ class verification(object):
 
     def generate_aes_config(self):
         # 生成16位随机key和iv
-        key = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
-        iv = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
+        key = ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(16))
+        iv = ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(16))
         
         config_id = str(int(time.time()))
         name = f"加密配置_{datetime.now(self.tz).strftime('%Y%m%d%H%M%S')}"
         
-        aes_configs = self.db_user.table('aes_configs')
-        result = aes_configs.insert({
+        result = self.db.insert_aes_config({
             'config_id': config_id,
             'name': name,
             'key': key,
@@ -370,6 +728,7 @@ class verification(object):
         })
         
         if result:
+            self._changed('aes_configs', config_id)
             return {'code': 10000, 'msg': 'AES配置生成成功', 'config_id': config_id, 'name': name}
         else:
             return {'code': 10050, 'msg': 'AES配置生成失败'}
@@ -378,42 +737,144 @@ class verification(object):
         if config_id == 'default':
             return {'code': 10051, 'msg': '默认加密配置不可删除'}
         
-        aes_configs = self.db_user.table('aes_configs')
-        # 检查是否有用户使用此配置
-        users_with_config = self.db_user.search(Query().aes_config_id == config_id)
-        if users_with_config:
-            # 将这些用户的配置重置为默认
-            for user in users_with_config:
-                self.db_user.update({'aes_config_id': 'default'}, Query().machine_code == user['machine_code'])
-        
-        result = aes_configs.remove(Query().config_id == config_id)
-        if len(result) > 0:
+        with self.db.transaction():
+            # 将使用此配置的用户的配置重置为默认
+            machine_codes = self.db.update_users_where('aes_config_id', config_id, {'aes_config_id': 'default'})
+            
+            result = self.db.remove_aes_config(config_id)
+        self._changed('user', *machine_codes)
+        if result:
+            self._changed('aes_configs', config_id)
             return {'code': 10000, 'msg': 'AES配置删除成功'}
         return {'code': 10052, 'msg': 'AES配置删除失败'}
 
     def update_user_aes(self, machine_code, aes_config_id):
-        result = self.db_user.update({'aes_config_id': aes_config_id}, Query().machine_code == machine_code)
-        if len(result) == 1:
+        result = self.db.update_user(machine_code, {'aes_config_id': aes_config_id})
+        if result:
+            self._changed('user', machine_code)
             return {'code': 10000, 'msg': 'AES配置更新成功'}
         return {'code': 10053, 'msg': 'AES配置更新失败'}
 
     # 工具函数集
     def new_card_number(self):
         local_time = time.strftime('%Y%m%d', time.localtime(time.time()))
-        card_number = local_time + self.random_str(5)
+        card_number = local_time + self.random_str(CARD_NUMBER_LENGTH)
         return card_number
 
     def random_str(self, randomlength=8):
-        result_str = ''
-        chars = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
-        length = len(chars) - 1
-        random = Random()
-        for i in range(randomlength):
-            result_str += chars[random.randint(0, length)]
-        return result_str
+        # 按字节表映射成大写字母，丢弃会导致取模偏差的字节
+        result = b''
+        while len(result) < randomlength:
+            result += secrets.token_bytes(randomlength + randomlength // 8 + 8).translate(CARD_TABLE, CARD_REJECT)
+        return result[:randomlength].decode('ascii')
 
     def get_server_time(self):
-        return datetime.now(self.tz).strftime('%Y-%m-%d %H:%M:%S')
+        return clock.now_str()
+
+    def close(self):
+        self.db.close()
+
+
+# 异步封装，供Sanic处理函数await调用
+class AsyncVerification(object):
+
+    # 只访问内存的方法，直接在事件循环中执行(export_*只创建迭代器，实际读取通过run_read()在读线程中进行)
+    INLINE_METHODS = {
+        'get_server_time', 'export_users', 'export_cards', 'get_stats', 'recharge_precheck',
+        'get_lease_revocations',
+    }
+    # 只读方法，在读线程池中并发执行
+    READ_METHODS = {
+        'login', 'login_batch', 'get_user_aes_config', 'get_card', 'search_card', 'get_user', 'search_user',
+        'get_app_categories', 'get_aes_configs', 'get_expiring_users', 'get_expired_users', 'get_expiry_buckets',
+        'rebuild_filters', 'refresh_lease',
+    }
+    # 写方法，按提交顺序在唯一的写线程中串行执行
+    WRITE_METHODS = {
+        'reg', 'recharge', 'make_new_card', 'delete_card', 'update_user', 'delete_user',
+        'add_app_category', 'delete_app_category', 'update_user_app', 'update_user_remark',
+        'generate_aes_config', 'delete_aes_config', 'update_user_aes', 'import_users', 'import_cards',
+        'generate_cards', 'sweep_expired_users',
+    }
+
+    def __init__(self, verify: verification, read_workers=4):
+        """
+        把verification的同步方法放到线程中执行，数据库读写和JSON序列化不再阻塞事件循环
+        verify: verification实例
+        read_workers: 读线程池大小
+        """
+        self.verify = verify
+        self.read_workers = read_workers
+        self._reader = None
+        self._writer = None
+
+    def _executor(self, write):
+        # 线程池在首次调用时创建，shutdown()后可再次创建
+        if write:
+            if self._writer is None:
+                self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='verify-write')
+            return self._writer
+        if self._reader is None:
+            self._reader = ThreadPoolExecutor(max_workers=self.read_workers, thread_name_prefix='verify-read')
+        return self._reader
+
+    # 缓存命中时在事件循环中直接返回，未命中时到读线程池中查询数据库
+    async def get_user_cryptor(self, machine_code, padding_mode='ZeroPadding'):
+        cryptor = self.verify.cached_user_cryptor(machine_code, padding_mode)
+        if cryptor is None:
+            cryptor = await self.run_read(self.verify.get_user_cryptor, machine_code, padding_mode)
+        return cryptor
+
+    async def get_cryptor(self, config_id='default', padding_mode='ZeroPadding'):
+        cryptor = self.verify.cached_cryptor(config_id, padding_mode)
+        if cryptor is None:
+            cryptor = await self.run_read(self.verify.get_cryptor, config_id, padding_mode)
+        return cryptor
+
+    async def run_read(self, func, *args):
+        """在读线程池中执行只读函数，如逐块读取export_*返回的迭代器"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor(False), functools.partial(func, *args))
+
+    def __getattr__(self, name):
+        if name in self.INLINE_METHODS:
+            method = getattr(self.verify, name)
+
+            async def call_inline(*args, **kwargs):
+                return method(*args, **kwargs)
+
+            setattr(self, name, call_inline)
+            return call_inline
+        if name in self.READ_METHODS:
+            write = False
+        elif name in self.WRITE_METHODS:
+            write = True
+        else:
+            raise AttributeError(name)
+        method = getattr(self.verify, name)
+
+        kind = 'write' if write else 'read'
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            start = time.perf_counter()
+            try:
+                return await loop.run_in_executor(self._executor(write), functools.partial(method, *args, **kwargs))
+            finally:
+                STORAGE_SECONDS.observe(time.perf_counter() - start, name, kind)
+
+        # 缓存包装后的方法，下次不再经过__getattr__
+        setattr(self, name, call)
+        return call
+
+    def shutdown(self):
+        """等待已提交的读写完成并释放线程池"""
+        writer, self._writer = self._writer, None
+        reader, self._reader = self._reader, None
+        if writer is not None:
+            writer.shutdown(wait=True)
+        if reader is not None:
+            reader.shutdown(wait=True)
 
 
 if __name__ == '__main__':
@@ -424,11 +885,11 @@ if __name__ == '__main__':
     # print(v.login('123456789111111'))
     # print(v.make_new_card(100, 90))
     # print(v.recharge('223456789111111', '20220901BRDID', 'HGVSPQGE'))
-    # print(v.get_card(1, 5))  # (1, 5)=[0, 5],(2, 5)=[5, 10]
+    # print(v.get_card(5))  # 第一页，下一页为 v.get_card(5, before=上一次返回的last_id)
     # print(v.delete_card('20220905ZQUCY'))
     # print(v.search_card('20220905NLHYL'))
 
-    # print(v.get_user(1, 5))  # (1, 5)=[0, 5],(2, 5)=[5, 10]
+    # print(v.get_user(5))
     # print(v.update_user('123456789111111', '2021-12-31 13:29:59'))
     # print(v.delete_user('123456789111111'))
     # print(v.search_user('123456789111111'))